@@ -0,0 +1,470 @@
+import io
+import copy
+import asyncio
+import threading
+import importlib.resources
+import numpy as np
+from os import PathLike
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageCms, ImageSequence
+from PIL.Image import Resampling
+from PIL.ImageOps import exif_transpose
+from .modules.color import TransformCache, make_profile_transform, make_fake_transforms
+from .modules.core import halftone_grayscale_image, halftone_rgb_image, halftone_cmyk_image, halftone_image_mode_bands, halftone_frame_mode, sharing, reusing, qualities, GeometryCache
+from .modules.stats import stage, scope
+
+from . import __spec__ as spec
+root = importlib.resources.files(spec.parent if spec is not None else __package__)
+# ファイルを開いたままにしないようにメモリ上に読み込む（フォークしたワーカープロセスとファイルの読み取り位置を共有しないため）
+with importlib.resources.as_file(root / "profiles" / "SWOP.icc") as path:
+	default_cmyk_profile = ImageCms.getOpenProfile(io.BytesIO(path.read_bytes()))
+with importlib.resources.as_file(root / "profiles" / "sRGB.icc") as path:
+	default_rgb_profile = ImageCms.getOpenProfile(io.BytesIO(path.read_bytes()))
+with importlib.resources.as_file(root / "profiles" / "sGray.icc") as path:
+	default_gray_profile = ImageCms.getOpenProfile(io.BytesIO(path.read_bytes()))
+
+# 網点化する色空間とチャンネルの名前
+color_modes = {"gray": "L", "rgb": "RGB", "cmyk": "CMYK"}
+channel_names = {"L": ("gray",), "RGB": ("red", "green", "blue"), "CMYK": ("cyan", "magenta", "yellow", "key")}
+
+# ICC プロファイルを読み込む（パス、バイト列、プロファイルのいずれかを受け付け、None なら既定のプロファイルを返す）
+def load_profile(profile, default):
+	if profile is None:
+		return default
+	elif isinstance(profile, ImageCms.ImageCmsProfile):
+		return profile
+	elif isinstance(profile, bytes):
+		return ImageCms.ImageCmsProfile(io.BytesIO(profile))
+	elif isinstance(profile, (str, PathLike)):
+		return ImageCms.getOpenProfile(str(profile))
+	else:
+		raise TypeError("profile must be a path, bytes or an ImageCmsProfile")
+
+# NumPy の配列を画像にする（4 チャンネルは mode を指定しなければ RGBA とみなす）
+def array_image(array, mode=None):
+	array = np.asarray(array)
+	if array.dtype != np.uint8:
+		if not np.issubdtype(array.dtype, np.floating):
+			raise ValueError("arrays must be uint8 or floating point within 0.0-1.0")
+		array = np.rint(np.clip(array, 0.0, 1.0) * 255).astype(np.uint8)
+	if mode is None:
+		if array.ndim == 2:
+			mode = "L"
+		elif array.ndim == 3 and array.shape[2] in [2, 3, 4]:
+			mode = {2: "LA", 3: "RGB", 4: "RGBA"}[array.shape[2]]
+		else:
+			raise ValueError("unsupported array shape")
+	if len(mode) != (1 if array.ndim == 2 else array.shape[2]):
+		raise ValueError(f"array shape does not match mode: {mode}")
+	array = np.ascontiguousarray(array)
+	return Image.frombuffer(mode, (array.shape[1], array.shape[0]), array, "raw", mode, 0, 1)
+
+# アルファチャンネルを分離した画像とアルファチャンネル（無ければ None）を返す
+def split_alpha(img):
+	alpha = None
+	if img.mode == "LA":
+		alpha = img.split()[1]
+		img = img.convert("L")
+	elif img.mode == "RGBA":
+		alpha = img.split()[3]
+		img = img.convert("RGB")
+	elif img.mode == "P":
+		rgba = img.convert("RGBA")
+		alpha = rgba.split()[3]
+		img = rgba.convert("RGB")
+	return img, alpha
+
+# 大きさ size の出力画像の矩形 (left, top, width, height) に対応するアルファチャンネルを返す
+def resize_alpha(alpha, size, region):
+	left, top, width, height = region
+	sx, sy = alpha.width / size[0], alpha.height / size[1]
+	return alpha.resize((width, height), Resampling.LANCZOS, box=(left * sx, top * sy, (left + width) * sx, (top + height) * sy))
+
+# アルファチャンネルを再合成した画像を返す
+def recomposite(complete, alpha):
+	if complete.mode in ["RGB", "L"]:
+		width, height = complete.size
+		if (width, height) != alpha.size:
+			alpha = alpha.resize((width, height), Resampling.LANCZOS)
+		complete = Image.merge(complete.mode + "A", (*complete.split(), alpha))
+		# 透明ピクセルの色を平坦化
+		if complete.mode == "RGBA":
+			transparent = (255, 255, 255, 0)
+			bg = Image.new("RGBA", complete.size, transparent)
+			complete = Image.alpha_composite(bg, complete)
+	return complete
+
+# 変種ごとに変えられる網点化の設定
+variant_settings = ["pitch", "scale", "blur", "blur_radius", "resample", "engine", "quality", "gray_angle", "rgb_angles", "cmyk_angles"]
+
+# 網点化の設定を保持して画像を網点化する変換器
+# ICC プロファイルの読み込みと色空間の変換関数の作成は構築時に一度だけ行う
+class Converter:
+	def __init__(
+		self, *, pitch=4, scale=1.0, blur=None, blur_radius=None, resample="linear", engine="cairo", quality="normal",
+		gray_angle=45, rgb_angles=(15, 75, 30), cmyk_angles=(15, 75, 30, 45), mode="auto", output="auto", tiff=False,
+		gray_profile=None, input_gray_profile=None, rgb_profile=None, input_rgb_profile=None, cmyk_profile=None, input_cmyk_profile=None,
+		gray_intent=1, rgb_intent=1, cmyk_intent=1, orientation=False, ignore_embedded=False, discard_profile=False, opaque=False,
+		naive=False, gamma_correction=False, key_from=0.5, naive_lut=False, keep=(), workers=1, max_memory=None, cache=None, geometry_cache=None,
+	):
+		if mode not in ["auto", *color_modes]:
+			raise ValueError(f"invalid mode: {mode}")
+		if output not in ["auto", *color_modes]:
+			raise ValueError(f"invalid output: {output}")
+		if blur not in [None, "box", "gaussian"]:
+			raise ValueError(f"invalid blur: {blur}")
+		if quality not in qualities:
+			raise ValueError(f"invalid quality: {quality}")
+		keep = {"red", "green", "blue", "cyan", "magenta", "yellow", "key"} if keep == "all" else set(keep)
+		self.pitch = pitch
+		self.scale = scale
+		self.blur = None if blur is None else (blur, blur_radius)
+		self.resample = resample
+		self.engine = engine
+		self.quality = quality
+		self.angles = {"L": (gray_angle,), "RGB": tuple(rgb_angles), "CMYK": tuple(cmyk_angles)}
+		self.keep_flags = {m: tuple(c in keep for c in names) if m != "L" else (False,) for m, names in channel_names.items()}
+		self.mode = mode
+		self.output = output
+		self.tiff = tiff
+		self.orientation = orientation
+		self.discard_profile = discard_profile
+		self.opaque = opaque
+		self.workers = workers
+		self.max_memory = max_memory
+		self.cache = TransformCache() if cache is None else cache
+		# 網点の配置のキャッシュ（False なら使い回さない、max_memory を指定したときの既定の上限はそれ以下にする）
+		if geometry_cache is None:
+			geometry_cache = GeometryCache() if max_memory is None else GeometryCache(min(GeometryCache().max_memory, max_memory))
+		self.geometry_cache = None if geometry_cache is False else geometry_cache
+		# 色空間を変換する関数を作成する（キーは変換元のモード、変換先のモード、変換元に入力用のプロファイルを使うか）
+		self.transforms = {}
+		if naive:
+			rgb_cmyk, cmyk_rgb = make_fake_transforms(key_from, gamma_correction, lut=naive_lut)
+			gray_rgb = lambda img: img.convert("RGB")
+			rgb_gray = lambda img: img.convert("L")
+			naive_transforms = {
+				("RGB", "CMYK"): rgb_cmyk,
+				("CMYK", "RGB"): cmyk_rgb,
+				("L", "RGB"): gray_rgb,
+				("RGB", "L"): rgb_gray,
+				("L", "CMYK"): lambda img: rgb_cmyk(gray_rgb(img)),
+				("CMYK", "L"): lambda img: rgb_gray(cmyk_rgb(img)),
+			}
+			for (src, dst), fn in naive_transforms.items():
+				self.transforms[src, dst, False] = self.transforms[src, dst, True] = fn
+		else:
+			profiles = {
+				"L": load_profile(gray_profile, default_gray_profile),
+				"RGB": load_profile(rgb_profile, default_rgb_profile),
+				"CMYK": load_profile(cmyk_profile, default_cmyk_profile),
+			}
+			in_profiles = {
+				"L": load_profile(input_gray_profile, default_gray_profile),
+				"RGB": load_profile(input_rgb_profile, default_rgb_profile),
+				"CMYK": load_profile(input_cmyk_profile, default_cmyk_profile),
+			}
+			intents = {"L": gray_intent, "RGB": rgb_intent, "CMYK": cmyk_intent}
+			for src in profiles:
+				for dst in profiles:
+					if src != dst:
+						for inp in [False, True]:
+							source = in_profiles[src] if inp else profiles[src]
+							self.transforms[src, dst, inp] = make_profile_transform((source, profiles[dst]), (src, dst), intents[dst], not ignore_embedded, cache=self.cache)
+
+	# 網点化の設定の一部を変えた変換器を返す（ICC プロファイルと色空間の変換関数は共有する）
+	def derive(self, **settings):
+		for k in settings:
+			if k not in variant_settings:
+				raise TypeError(f"setting cannot be changed for a variant: {k}")
+		variant = copy.copy(self)
+		variant.pitch = settings.get("pitch", self.pitch)
+		variant.scale = settings.get("scale", self.scale)
+		blur = settings.get("blur", None if self.blur is None else self.blur[0])
+		blur_radius = settings.get("blur_radius", None if self.blur is None else self.blur[1])
+		if blur not in [None, "box", "gaussian"]:
+			raise ValueError(f"invalid blur: {blur}")
+		variant.blur = None if blur is None else (blur, blur_radius)
+		variant.resample = settings.get("resample", self.resample)
+		variant.engine = settings.get("engine", self.engine)
+		variant.quality = settings.get("quality", self.quality)
+		if variant.quality not in qualities:
+			raise ValueError(f"invalid quality: {variant.quality}")
+		variant.angles = {
+			"L": (settings.get("gray_angle", self.angles["L"][0]),),
+			"RGB": tuple(settings.get("rgb_angles", self.angles["RGB"])),
+			"CMYK": tuple(settings.get("cmyk_angles", self.angles["CMYK"])),
+		}
+		return variant
+
+	# 画像をハーフトーンの色空間へ変換し、変換しなかったかどうかと合わせて返す
+	def to_halftone_space(self, img):
+		if self.mode == "auto":
+			target = "L" if img.mode == "L" else "CMYK"
+		else:
+			target = color_modes[self.mode]
+		if img.mode == target:
+			return img, True
+		return self.transforms[img.mode, target, True](img), False
+
+	# 網点化した画像を目的の出力モードへ変換する
+	def output_conversion(self, halftone, same):
+		if self.output == "auto":
+			target = "RGB" if halftone.mode == "CMYK" else halftone.mode
+		else:
+			target = color_modes[self.output]
+		if halftone.mode == target:
+			return halftone
+		return self.transforms[halftone.mode, target, same](halftone)
+
+	# 画像のモードに応じた網点の角度と網点化しないチャンネルのフラグを返す
+	def channel_settings(self, mode):
+		return self.angles[mode], self.keep_flags[mode]
+
+	# ハーフトーンの色空間の画像を網点化した出力画像の大きさを返す
+	def output_size(self, target):
+		return round(target.width * self.scale), round(target.height * self.scale)
+
+	# 出力画像の矩形 (left, top, width, height) を出力画像に収まるように切り詰めて返す
+	def clip_region(self, target, region):
+		if region is None:
+			return None
+		width, height = self.output_size(target)
+		left, top, w, h = region
+		right, bottom = min(width, left + w), min(height, top + h)
+		left, top = max(0, left), max(0, top)
+		if right <= left or bottom <= top:
+			raise ValueError("region does not overlap the output image")
+		return left, top, right - left, bottom - top
+
+	# ハーフトーンの色空間の画像を網点化した画像を返す
+	# region (left, top, width, height) を指定すると出力画像のその矩形だけを描画する
+	def halftone(self, target, progress_callbacks=None, workers=None, region=None):
+		angles, keep_flags = self.channel_settings(target.mode)
+		if progress_callbacks is None:
+			progress_callbacks = (None,) * len(angles)
+		if workers is None:
+			workers = self.workers
+		with reusing(self.geometry_cache):
+			if target.mode == "L":
+				with scope("L"):
+					return halftone_grayscale_image(target, self.pitch, angles[0], self.scale, self.blur, self.resample, progress_callback=progress_callbacks[0], max_memory=self.max_memory, engine=self.engine, quality=self.quality, region=region)
+			elif target.mode == "RGB":
+				return halftone_rgb_image(target, self.pitch, angles, self.scale, self.blur, self.resample, keep_flags, progress_callbacks=progress_callbacks, workers=workers, max_memory=self.max_memory, engine=self.engine, quality=self.quality, region=region)
+			elif target.mode == "CMYK":
+				return halftone_cmyk_image(target, self.pitch, angles, self.scale, self.blur, self.resample, keep_flags, progress_callbacks=progress_callbacks, workers=workers, max_memory=self.max_memory, engine=self.engine, quality=self.quality, region=region)
+			else:
+				raise ValueError(f"unsupported image mode for halftone: {target.mode}")
+
+	# ハーフトーンの色空間の画像を網点化した画像を上から帯状に分割して返すイテレータ
+	def halftone_bands(self, target, progress_callbacks=None, region=None):
+		angles, keep_flags = self.channel_settings(target.mode)
+		with reusing(self.geometry_cache):
+			yield from halftone_image_mode_bands(target, self.pitch, angles, self.scale, self.blur, self.resample, keep_flags, progress_callbacks=progress_callbacks, max_memory=self.max_memory, engine=self.engine, quality=self.quality, region=region)
+
+	# 連続するフレームのハーフトーンの色空間の画像を網点化した画像と、次のフレームへ引き継ぐ状態を返す
+	# previous は前のフレームの状態で、標本値の変化が threshold 以下の網点は前のフレームのまま描き直さない
+	def halftone_frame(self, target, progress_callbacks=None, region=None, previous=None, threshold=0.0):
+		angles, keep_flags = self.channel_settings(target.mode)
+		with reusing(self.geometry_cache):
+			return halftone_frame_mode(target, self.pitch, angles, self.scale, self.blur, self.resample, keep_flags, progress_callbacks=progress_callbacks, engine=self.engine, quality=self.quality, region=region, previous=previous, threshold=threshold)
+
+	# 網点化した画像を出力モードへ変換し、アルファチャンネルを再合成した最終的な画像を返す
+	def finish(self, halftone, same, alpha=None):
+		with stage("output_conversion"):
+			complete = self.output_conversion(halftone, same)
+		if alpha is not None and not self.opaque:
+			with stage("recomposite"):
+				complete = recomposite(complete, alpha)
+		# 必要なら ICC プロファイルを廃棄する
+		if self.discard_profile:
+			if complete.info.get("icc_profile"):
+				complete.info.pop("icc_profile")
+		return complete
+
+	# 画像の向きを補正してアルファチャンネルを分離し、ハーフトーンの色空間へ変換する
+	# ハーフトーンの色空間の画像、変換しなかったかどうか、アルファチャンネルを返す
+	def prepare(self, img):
+		if self.orientation:
+			with stage("exif_transpose"):
+				img = exif_transpose(img)
+		with stage("alpha_split"):
+			img, alpha = split_alpha(img)
+		if img.mode not in ["L", "RGB", "CMYK"]:
+			raise ValueError("unsupported image type")
+		with stage("convert"):
+			target, same = self.to_halftone_space(img)
+		return target, same, alpha
+
+	# 画像を網点化して出力モードの画像を返す
+	# PIL の画像か NumPy の配列を受け付け、配列を渡した場合は配列で返す（配列のモードは mode で指定できる）
+	# progress_callback はチャンネルの名前と進捗（0.0-1.0）で呼ばれる
+	# region (left, top, width, height) を指定すると出力画像のその矩形（出力画像に収まるように切り詰める）だけを返す
+	def convert(self, image, mode=None, progress_callback=None, region=None):
+		array = not isinstance(image, Image.Image)
+		target, same, alpha = self.prepare(array_image(image, mode) if array else image)
+		region = self.clip_region(target, region)
+		progress_callbacks = None
+		if progress_callback is not None:
+			progress_callbacks = tuple(partial(progress_callback, name) for name in channel_names[target.mode])
+		with stage("halftone"):
+			halftone = self.halftone(target, progress_callbacks, region=region)
+		if alpha is not None and region is not None:
+			alpha = resize_alpha(alpha, self.output_size(target), region)
+		complete = self.finish(halftone, same, alpha)
+		return np.asarray(complete) if array else complete
+
+	# 1 つの画像を網点化の設定の異なる複数の変種へ網点化して出力モードの画像のリストを返す
+	# variants は derive に渡す設定の辞書のリストで、デコード、色空間の変換、ぼかし、リサンプリング用の配列を共有する
+	# progress_callback は変種の番号、チャンネルの名前、進捗で呼ばれる
+	def variants(self, image, variants, mode=None, progress_callback=None, region=None):
+		array = not isinstance(image, Image.Image)
+		target, same, alpha = self.prepare(array_image(image, mode) if array else image)
+		results = []
+		with sharing():
+			for k, settings in enumerate(variants):
+				variant = self.derive(**settings)
+				progress_callbacks = None
+				if progress_callback is not None:
+					progress_callbacks = tuple(partial(progress_callback, k, name) for name in channel_names[target.mode])
+				clipped = variant.clip_region(target, region)
+				with stage("halftone"):
+					halftone = variant.halftone(target, progress_callbacks, region=clipped)
+				cropped = alpha
+				if alpha is not None and clipped is not None:
+					cropped = resize_alpha(alpha, variant.output_size(target), clipped)
+				complete = variant.finish(halftone, same, cropped)
+				results.append(np.asarray(complete) if array else complete)
+		return results
+
+	# 動画像のフレームか画像のイテラブルを順に網点化して出力モードの画像を返すイテレータ
+	# フレームは必要になるまで読み込まず、網点の中心の座標は同じ大きさのフレームの間で使い回す
+	# threshold を指定すると標本値の変化がそれ以下の網点は前のフレームのまま描き直さない
+	# progress_callback はフレームの番号、チャンネルの名前、進捗で呼ばれる
+	def sequence(self, frames, mode=None, progress_callback=None, region=None, threshold=0.0):
+		if isinstance(frames, Image.Image):
+			frames = ImageSequence.Iterator(frames)
+		states = None
+		for j, frame in enumerate(frames):
+			array = not isinstance(frame, Image.Image)
+			# 動画像のフレームは次のフレームを読み込むと書き換わるので複製する
+			target, same, alpha = self.prepare(array_image(frame, mode) if array else frame.copy())
+			clipped = self.clip_region(target, region)
+			progress_callbacks = None
+			if progress_callback is not None:
+				progress_callbacks = tuple(partial(progress_callback, j, name) for name in channel_names[target.mode])
+			with stage("halftone"):
+				halftone, states = self.halftone_frame(target, progress_callbacks, clipped, states, threshold)
+			if alpha is not None and clipped is not None:
+				alpha = resize_alpha(alpha, self.output_size(target), clipped)
+			complete = self.finish(halftone, same, alpha)
+			yield np.asarray(complete) if array else complete
+
+	# 画像の保存形式を返す
+	def output_format(self, mode):
+		return "TIFF" if mode == "CMYK" or self.tiff else "PNG"
+
+	# 網点化した画像を PNG か TIFF のバイト列にエンコードする（配列のモードは mode で指定できる）
+	def encode(self, image, format=None, mode=None):
+		if not isinstance(image, Image.Image):
+			image = array_image(image, mode)
+		with stage("save"), io.BytesIO() as buf:
+			image.save(buf, format=format or self.output_format(image.mode))
+			return buf.getvalue()
+
+# 非同期の変換が取り消されたときに変換中のスレッドで送出される例外
+class ConversionCancelled(Exception):
+	pass
+
+# イベントループを止めないように変換器の処理をエグゼキュータで実行する非同期の変換器
+# 同時に実行する変換を concurrency 件までに制限し、それを超える呼び出しは空きが出るまで待たせる
+# 取り消しはチャンネルの処理中に進捗が報告される時点で反映される
+class AsyncConverter:
+	def __init__(self, converter=None, *, concurrency=1, executor=None, **kwargs):
+		if converter is None:
+			converter = Converter(**kwargs)
+		elif kwargs:
+			raise TypeError("settings cannot be given together with a converter")
+		if concurrency < 1:
+			raise ValueError("concurrency must be at least 1")
+		self.converter = converter
+		self.concurrency = concurrency
+		self.owns_executor = executor is None
+		self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="halftonecv") if executor is None else executor
+		self.semaphore = None
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc_info):
+		self.close()
+
+	# 所有するエグゼキュータを終了する
+	def close(self):
+		if self.owns_executor:
+			self.executor.shutdown(wait=False, cancel_futures=True)
+
+	# 同時に実行する変換の数を制限するセマフォを返す（Python 3.9 ではイベントループの中で作る必要がある）
+	def limit(self):
+		if self.semaphore is None:
+			self.semaphore = asyncio.Semaphore(self.concurrency)
+		return self.semaphore
+
+	# 関数をエグゼキュータで実行して結果を待つ
+	# 待っているタスクが取り消されたら関数の中で ConversionCancelled を送出させ、実際に止まるまで待ってから取り消す
+	async def run(self, fn, *args, progress_callback=None):
+		loop = asyncio.get_running_loop()
+		cancelled = threading.Event()
+		def check():
+			if cancelled.is_set():
+				raise ConversionCancelled()
+		def report(channel, value):
+			check()
+			if progress_callback is not None:
+				loop.call_soon_threadsafe(progress_callback, channel, value)
+		def call():
+			check()
+			return fn(*args, report)
+		async with self.limit():
+			future = loop.run_in_executor(self.executor, call)
+			try:
+				return await asyncio.shield(future)
+			except asyncio.CancelledError:
+				cancelled.set()
+				try:
+					await future
+				except Exception:
+					pass
+				raise
+
+	# 画像を網点化して出力モードの画像を返す（引数は Converter.convert と同じ）
+	# progress_callback はイベントループのスレッドでチャンネルの名前と進捗で呼ばれる
+	async def convert(self, image, mode=None, progress_callback=None, region=None):
+		return await self.run(lambda image, mode, report: self.converter.convert(image, mode, report, region), image, mode, progress_callback=progress_callback)
+
+	# 網点化した画像を PNG か TIFF のバイト列にエンコードする
+	async def encode(self, image, format=None, mode=None):
+		return await self.run(lambda image, format, mode, report: self.converter.encode(image, format, mode), image, format, mode)
+
+	# 画像を網点化しながら進捗のイベントを返す非同期イテレータ
+	# ("progress", チャンネルの名前, 進捗) を順に返し、最後に ("result", 画像) を返す
+	# 途中でイテレータを閉じると変換を取り消す
+	async def stream(self, image, mode=None, region=None):
+		events = asyncio.Queue()
+		task = asyncio.ensure_future(self.convert(image, mode, lambda channel, value: events.put_nowait(("progress", channel, value)), region))
+		task.add_done_callback(lambda task: events.put_nowait(None))
+		try:
+			while True:
+				event = await events.get()
+				if event is None:
+					break
+				yield event
+			yield "result", task.result()
+		finally:
+			if not task.done():
+				task.cancel()
+				try:
+					await task
+				except (asyncio.CancelledError, ConversionCancelled):
+					pass
@@ -0,0 +1,212 @@
+import io
+import sys
+import json
+import platform
+import numpy as np
+from time import perf_counter
+from glob import glob
+from os.path import basename, dirname, join, isdir
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from PIL import Image, ImageOps
+from . import __version__ as version
+from .api import default_gray_profile, default_rgb_profile, default_cmyk_profile
+from .modules.args import positive, natural, choice
+from .modules.color import make_profile_transform
+from .modules.core import normalized_radius_table, load_radius_table, make_radius, halftone_dot_chunks, draw_dots, halftone_image
+
+# リポジトリに同梱されたサンプル画像のディレクトリ
+samples_directory = join(dirname(dirname(__file__)), "images")
+
+# 階調と細部を含む合成画像を返す
+def synthetic_image(width, height, seed=0):
+	rng = np.random.default_rng(seed)
+	x = np.linspace(0.0, 1.0, width)[np.newaxis, :]
+	y = np.linspace(0.0, 1.0, height)[:, np.newaxis]
+	channels = []
+	for k in range(3):
+		wave = 0.5 + 0.25 * np.sin((40 + 7 * k) * x + k) * np.cos((30 - 5 * k) * y)
+		noise = rng.normal(0.0, 0.05, (height, width))
+		channels.append(np.clip((x + y) / 2 * 0.5 + wave * 0.5 + noise, 0.0, 1.0))
+	return Image.fromarray(np.rint(np.stack(channels, axis=-1) * 255).astype(np.uint8), "RGB")
+
+# 関数を繰り返し実行して最短の実行時間と結果を返す
+def measure(fn, repeat=1):
+	best = None
+	for _ in range(repeat):
+		start = perf_counter()
+		result = fn()
+		elapsed = perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+# 2 つのシングルバンド画像の差を返す
+def fidelity(reference, image):
+	a = np.asarray(reference, dtype=np.float64)
+	b = np.asarray(image, dtype=np.float64)
+	error = np.abs(a - b)
+	mse = float(np.mean(error ** 2))
+	return {
+		"mean_abs_error": float(np.mean(error)),
+		"max_abs_error": float(np.max(error)),
+		"mean_tone_difference": float(np.mean(b) - np.mean(a)),
+		"psnr": None if mse == 0 else float(10 * np.log10(255 ** 2 / mse)),
+	}
+
+# 網点化する色空間への変換関数を返す
+def mode_conversion(mode):
+	if mode == "gray":
+		return make_profile_transform((default_rgb_profile, default_gray_profile), ("RGB", "L"), 1, False, lazy=False)
+	elif mode == "cmyk":
+		return make_profile_transform((default_rgb_profile, default_cmyk_profile), ("RGB", "CMYK"), 1, False, lazy=False)
+	else:
+		return lambda image: image
+
+# 半径の表の構築と網点の大きさごとの表の作成にかかる時間を返す
+def bench_radius_table(pitches, repeat=1, depth=2 ** 16):
+	t_build, _ = measure(lambda: normalized_radius_table(depth), repeat)
+	load_radius_table(depth)
+	results = {"depth": depth, "build_sec": t_build, "make_radius_sec": {}}
+	for pitch in pitches:
+		def run():
+			make_radius.cache_clear()
+			return make_radius(pitch, depth)
+		results["make_radius_sec"][str(pitch)] = measure(run, repeat)[0]
+	return results
+
+# 1 つの画像と設定について網点化の各段階の実行時間を返す
+def bench_case(data, mode, pitch, scale, resampler, engines, angle=45, repeat=1, qualities=()):
+	stages = {}
+	# デコード
+	stages["decode"], source = measure(lambda: Image.open(io.BytesIO(data)).convert("RGB"), repeat)
+	# 網点化する色空間への変換
+	convert = mode_conversion(mode)
+	stages["convert"], target = measure(lambda: convert(source), repeat)
+	# Gray と RGB は反転して黒地に白の網点として描画する
+	invert = target.mode in ["L", "RGB"]
+	channels = [ImageOps.invert(c) if invert else c for c in target.split()]
+	width, height = round(target.width * scale), round(target.height * scale)
+	radius = make_radius(pitch, 2 ** 16)
+	# チャンネルごとに網点の標本化と描画を行う
+	stages["sample"] = 0.0
+	for engine in engines:
+		stages[f"render_{engine}"] = 0.0
+	dots = []
+	outputs = {engine: [] for engine in engines}
+	for c in channels:
+		def sample():
+			chunks = list(halftone_dot_chunks(c, pitch, angle, None, resampler))
+			return [np.concatenate([np.zeros(0)] + [chunk[i] for chunk in chunks]) for i in range(3)]
+		t, (xs, ys, colors) = measure(sample, repeat)
+		stages["sample"] += t
+		dots.append(len(xs))
+		for engine in engines:
+			t, band = measure(lambda: draw_dots(xs, ys, colors, radius, scale, width, height, engine=engine, screen=(pitch, angle, (c.width / 2, c.height / 2))), repeat)
+			stages[f"render_{engine}"] += t
+			outputs[engine].append(band.copy())
+	# チャンネルの結合
+	bands = outputs[engines[0]]
+	stages["merge"], halftone = measure(lambda: Image.merge(target.mode, [ImageOps.invert(b) if invert else b for b in bands]), repeat)
+	# エンコード
+	fmt = "TIFF" if halftone.mode == "CMYK" else "PNG"
+	def encode():
+		with io.BytesIO() as buf:
+			halftone.save(buf, format=fmt)
+			return buf.tell()
+	stages["encode"], encoded = measure(encode, repeat)
+	result = {
+		"mode": mode,
+		"pitch": pitch,
+		"scale": scale,
+		"resampler": resampler,
+		"input_size": list(source.size),
+		"output_size": [width, height],
+		"dots": dots,
+		"encoded_bytes": encoded,
+		"stages_sec": stages,
+		"total_sec": sum(stages[k] for k in ["decode", "convert", "sample", f"render_{engines[0]}", "merge", "encode"]),
+	}
+	# 最初のラスタライザに対する他のラスタライザの忠実度
+	result["fidelity"] = {engine: [fidelity(a, b) for a, b in zip(outputs[engines[0]], outputs[engine])] for engine in engines[1:]}
+	# 品質ごとの網点化の実行時間と best に対する速度比と忠実度
+	if qualities:
+		times = {}
+		images = {}
+		for quality in dict.fromkeys([*qualities, "best"]):
+			run = lambda: [halftone_image(c, pitch, angle, scale, None, resampler, engine=engines[0], quality=quality) for c in channels]
+			times[quality], images[quality] = measure(run, repeat)
+		result["quality"] = {
+			quality: {
+				"halftone_sec": times[quality],
+				"speedup_vs_best": times["best"] / times[quality] if times[quality] > 0 else None,
+				"fidelity_vs_best": [fidelity(a, b) for a, b in zip(images["best"], images[quality])],
+			}
+			for quality in qualities
+		}
+	return result
+
+def main(argv=None):
+	parser = ArgumentParser(
+		prog="halftonecv-bench",
+		allow_abbrev=False,
+		formatter_class=ArgumentDefaultsHelpFormatter,
+		description="Benchmark each stage of the halftone pipeline and report the results as JSON",
+	)
+	parser.add_argument("images", metavar="FILE", nargs="*", help="describe input image files (synthetic images are used if omitted)")
+	parser.add_argument("--samples", action="store_true", help="also benchmark the sample images bundled in the repository")
+	parser.add_argument("-W", "--size", metavar="WxH", nargs="+", default=["512x384", "1024x768"], help="the sizes of synthetic images")
+	parser.add_argument("-p", "--pitch", metavar="PX", type=positive, nargs="+", default=[4, 8], help="pitches to benchmark")
+	parser.add_argument("-m", "--mode", type=choice, choices=["gray", "rgb", "cmyk"], nargs="+", default=["gray", "cmyk"], help="color space types to benchmark")
+	parser.add_argument("-F", "--resample", type=choice, choices=["nearest", "linear", "lanczos2", "lanczos3", "spline36", "area"], nargs="+", default=["linear", "lanczos2"], help="resampling methods to benchmark")
+	parser.add_argument("--engine", type=choice, choices=["cairo", "numpy", "screen"], nargs="+", default=["cairo", "numpy", "screen"], help="rasterizers to benchmark (the first one is the reference for fidelity)")
+	parser.add_argument("-Q", "--quality", type=choice, choices=["draft", "normal", "best"], nargs="*", default=["draft", "normal", "best"], help="rendering qualities to compare with best by the first rasterizer (pass no value to skip)")
+	parser.add_argument("-x", "--scale", type=positive, default=1, help="the scale factor of output images to input images")
+	parser.add_argument("-A", "--angle", metavar="DEG", type=float, default=45, help="screen angle")
+	parser.add_argument("-n", "--repeat", type=natural, default=1, help="run each stage N times and report the fastest")
+	parser.add_argument("-o", "--output", metavar="FILE", help="write the JSON report to FILE instead of stdout")
+	args = parser.parse_args(argv)
+	# 入力画像をエンコード済みのバイト列として用意する
+	sources = []
+	for f in args.images:
+		with open(f, "rb") as fp:
+			sources.append((f, fp.read()))
+	if args.samples and isdir(samples_directory):
+		for f in sorted(glob(join(samples_directory, "*.png"))):
+			with open(f, "rb") as fp:
+				sources.append((basename(f), fp.read()))
+	if not sources:
+		for size in args.size:
+			try:
+				width, height = (int(v) for v in size.lower().split("x"))
+			except ValueError:
+				parser.error(f"invalid size: {size}")
+			with io.BytesIO() as buf:
+				synthetic_image(width, height).save(buf, format="PNG")
+				sources.append((f"(synthetic {width}x{height})", buf.getvalue()))
+	# 段階ごとの実行時間を計測する
+	cases = []
+	for name, data in sources:
+		for mode in args.mode:
+			for pitch in args.pitch:
+				for resampler in args.resample:
+					print(f"{name} {mode} pitch={pitch} {resampler}", file=sys.stderr)
+					cases.append({"image": name, **bench_case(data, mode, pitch, args.scale, resampler, args.engine, args.angle, args.repeat, args.quality)})
+	report = {
+		"version": version,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"numpy": np.__version__,
+		"pillow": Image.__version__,
+		"radius_table": bench_radius_table(args.pitch, args.repeat),
+		"cases": cases,
+	}
+	if args.output is None:
+		json.dump(report, sys.stdout, indent=2)
+		print()
+	else:
+		with open(args.output, "w") as fp:
+			json.dump(report, fp, indent=2)
+			print(file=fp)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
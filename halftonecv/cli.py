@@ -1,34 +1,39 @@
 import sys
 import os
 import io
+import json
+import cProfile
+import pstats
+import tracemalloc
 import contextlib
-import importlib.resources
 from time import time
+from uuid import uuid4
+from types import SimpleNamespace
 from glob import glob
 from os.path import isfile
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from PIL import Image, ImageCms
-from PIL.Image import Resampling
-from PIL.ImageOps import exif_transpose
+from PIL import Image, ImageSequence
 from rich.console import Console
 from rich.progress import Progress, TextColumn, BarColumn, TaskProgressColumn
-from .modules.args import positive, rate, nonempty, fileinput, filenameseg, choice, intent
+from rich.markup import escape
+from .modules.args import positive, natural, rate, nonempty, fileinput, filenameseg, choice, intent, variant
 from .modules.utils import mkdirp, filepath, purefilename, altfilepath
-from .modules.color import make_profile_transform, make_fake_transforms
-from .modules.core import halftone_grayscale_image, halftone_rgb_image, halftone_cmyk_image
-
-from . import __spec__ as spec
-root = importlib.resources.files(spec.parent if spec is not None else __package__)
-with importlib.resources.as_file(root / "profiles" / "SWOP.icc") as path:
-	default_cmyk_profile = ImageCms.getOpenProfile(str(path))
-with importlib.resources.as_file(root / "profiles" / "sRGB.icc") as path:
-	default_rgb_profile = ImageCms.getOpenProfile(str(path))
-with importlib.resources.as_file(root / "profiles" / "sGray.icc") as path:
-	default_gray_profile = ImageCms.getOpenProfile(str(path))
-
-def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
+from .modules.color import TransformCache
+from .modules.stream import make_stream_writer, tee
+from .modules.parallel import imap_ordered, report_progress, prefetch, pipelined
+from .modules.manifest import Manifest, file_digest, value_digest
+from .modules.stats import Stats, activate, stage, timed, format_table
+from .modules.core import load_radius_table, make_radius, get_resampler, sharing, GeometryCache
+from .modules.raster import coverage_stamp
+from .api import Converter, resize_alpha
+
+def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False, cache=None, geometry_cache=None, served=False, job=None):
 	broken_pipe = False
 	exit_code = 0
+	manifest = None
+	report = None
+	profiler = None
+	tracing = False
 	console = Console(stderr=True)
 
 	def eprint(*args, **kwargs):
@@ -45,13 +50,14 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 			description="Halftone Converter: an image converter to generate halftone images",
 			epilog="'--' can be used to terminate option parsing so remaining arguments are treated as positional arguments.",
 		)
-		parser.add_argument("images", metavar="FILE", type=fileinput, nargs=("*" if inputs is not None and len(inputs) > 0 else "+"), help="describe input image files (pass '-' to specify stdin)")
+		parser.add_argument("images", metavar="FILE", type=fileinput, nargs="*", help="describe input image files (pass '-' to specify stdin)")
 		parser.add_argument("-v", "--version", action="version", version=version)
 		parser.add_argument("-q", "--quiet", action="store_true", help="suppress non-error messages")
 		parser.add_argument("-V", "--traceback", action="store_true", help="render tracebacks on error")
 		parser.add_argument("-e", "--exit", action="store_true", help="stop immediately by an error even if jobs remain")
 		parser.add_argument("-g", "--glob", action="store_true", help="interpret FILE values as glob patterns")
 		parser.add_argument("-f", "--force", action="store_true", help="overwrite existing files with the output")
+		parser.add_argument("--manifest", metavar="FILE", type=nonempty, help="skip input files whose output recorded in FILE is up to date, and record converted files in FILE")
 		dest_group = parser.add_mutually_exclusive_group()
 		dest_group.add_argument("-O", "--stdout", action="store_true", help="send output to standard output")
 		dest_group.add_argument("-d", "--directory", metavar="DIR", type=nonempty, default=".", help="save output images in DIR directory")
@@ -62,10 +68,19 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 		parser.add_argument("-x", "-s", "--scale", type=positive, default=1, help="the scale factor of output images to input images")
 		parser.add_argument("-b", "--blur", type=choice, choices=["box", "gaussian"], nargs="?", const="gaussian", help="apply blur effect to source images (if no blur type is specified, gaussian is used)")
 		parser.add_argument("-B", "--blur-radius", metavar="PX", type=positive, help="specify blur radius (if not specified, half of the pitch is used)")
-		parser.add_argument("-F", "--resample", type=choice, choices=["nearest", "linear", "lanczos2", "lanczos3", "spline36"], default="linear", help="resampling method for determining dot size")
+		parser.add_argument("-j", "--jobs", metavar="N", type=natural, default=1, help="process multiple input files, or the color channels of a single input file, in parallel using N processes")
+		parser.add_argument("--max-memory", metavar="MB", type=positive, help="render each channel in horizontal bands so that a rendering surface uses at most MB megabytes")
+		parser.add_argument("--geometry-cache", metavar="MB", type=positive, default=256, help="keep dot positions and resampling weights of up to MB megabytes to reuse them for files, variants and frames with the same size, pitch and angle (only used when several files, variants or frames are processed, and at most the --max-memory value)")
+		parser.add_argument("--engine", type=choice, choices=["cairo", "numpy", "screen"], default="cairo", help="rasterizer to draw halftone dots (numpy draws all dots at once with precomputed coverage stamps, screen compares each pixel with a threshold table of the dot cell without antialiasing)")
+		parser.add_argument("--quality", type=choice, choices=["draft", "normal", "best"], default="normal", help="rendering quality (draft samples a reduced image by nearest neighbor with 8-bit dot sizes and coarse antialiasing for quick previews)")
+		parser.add_argument("-F", "--resample", type=choice, choices=["nearest", "linear", "lanczos2", "lanczos3", "spline36", "area"], default="linear", help="resampling method for determining dot size (area averages each dot's cell, which suits large pitches)")
 		parser.add_argument("-A", "--angle", "--gray-angle", metavar="DEG", dest="gray_angle", type=float, default=45, help="arrange dots by DEG degrees in the Gray channel")
 		parser.add_argument("-t", "--Angles", "--rgb-angles", metavar="DEG", dest="rgb_angles", type=float, nargs=3, default=(15, 75, 30), help="arrange dots by DEG degrees in each RGB channel respectively")
 		parser.add_argument("-a", "--angles", "--cmyk-angles", metavar="DEG", dest="cmyk_angles", type=float, nargs=4, default=(15, 75, 30, 45), help="arrange dots by DEG degrees in each CMYK channel respectively")
+		parser.add_argument("--region", metavar=("X", "Y", "W", "H"), type=int, nargs=4, help="render only the W x H rectangle at (X, Y) of the output image, with the same dots as the whole image")
+		parser.add_argument("--variant", metavar="SPEC", type=variant, action="append", help="render a variant with settings changed by SPEC (e.g. 'pitch=6,angle=30,scale=2') instead of the base settings, sharing the decoding and color conversion; can be repeated to render several variants")
+		parser.add_argument("--sequence", type=choice, choices=["animate", "frames"], nargs="?", const="animate", help="halftone every frame of animated or multi-page inputs and save them as an animated PNG (or multi-page TIFF), or as numbered images with 'frames'")
+		parser.add_argument("--frame-threshold", metavar="RATE", type=rate, default=0.0, help="in sequence mode, keep the dots of the previous frame whose sampled values changed by at most RATE (0.0-1.0) and redraw only around changed dots")
 		parser.add_argument("-m", "--mode", type=choice, choices=["auto", "gray", "rgb", "cmyk"], default="auto", help="color space type to generate halftones")
 		parser.add_argument("-o", "--output", type=choice, choices=["auto", "gray", "rgb", "cmyk"], default="auto", help="color space type to save output images")
 		parser.add_argument("-T", "--tiff", "--out-tiff", action="store_true", help="output TIFF images instead of PNG images")
@@ -79,6 +94,11 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 		parser.add_argument("-C", "--cmyk-profile", metavar="CMYK_ICC_FILE", type=nonempty, help="specify ICC profile for transform to CMYK images")
 		parser.add_argument("-c", "--cmyk-intent", type=intent, choices=["per", "sat", "rel", "abs", 0, 1, 2, 3], default=1, help="rendering intent for transform to CMYK images")
 		parser.add_argument("-H", "--allow-huge", action="store_true", help="disable the limitation of input image size")
+		parser.add_argument("--stats", action="store_true", help="print time and peak memory of each processing stage, dot counts and cache hit rates")
+		parser.add_argument("--stats-json", metavar="FILE", type=nonempty, help="write the statistics of --stats to FILE as JSON")
+		parser.add_argument("--profile", metavar="STAGE", help="run cProfile while STAGE (e.g. 'halftone', 'sample', 'C/render') is running and print the results")
+		parser.add_argument("--profile-output", metavar="FILE", type=nonempty, help="save the cProfile results of --profile to FILE instead of printing them")
+		parser.add_argument("--serve", action="store_true", help="keep running and process jobs given as JSON lines on stdin, reusing ICC transforms and dot positions across jobs")
 		parser.add_argument("-X", "--orientation", action="store_true", help="apply Exif orientation")
 		parser.add_argument("--ignore", "--ignore-embedded-profile", action="store_true", help="don't use ICC profiles embedded in input images")
 		parser.add_argument("--discard", "--discard-profile", action="store_true", help="don't embed ICC profiles in output images")
@@ -86,6 +106,7 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 		parser.add_argument("--naive", "--naive-transform", action="store_true", help="use approximate conversion algorithm (naive transform) instead of ICC-based transform")
 		parser.add_argument("--gamma-correction", action="store_true", help="apply sRGB gamma correction for RGB-CMYK conversion when the naive transform is used")
 		parser.add_argument("--key", "--key-from", metavar="RATE", dest="key_from", type=rate, default=0.5, help="black component threshold within 0.0-1.0 for RGB-CMYK conversion when the naive transform is used")
+		parser.add_argument("--naive-lut", action="store_true", help="convert RGB to CMYK with a 256x256x256 lookup table (64 MiB) when the naive transform is used, which pays off for large or many images")
 		parser.add_argument("-K", "--keep-all", action="store_true", help="don't convert any channels to halftones")
 		parser.add_argument("--keep-red", action="store_true", help="don't convert R channels to halftones")
 		parser.add_argument("--keep-green", action="store_true", help="don't convert G channels to halftones")
@@ -98,6 +119,24 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 			args = parser.parse_args()
 		else:
 			args = parser.parse_args(argv)
+		if not args.images and not args.serve and not inputs:
+			parser.error("the following arguments are required: FILE")
+
+		# 標準入力からジョブを受け取って処理し続ける
+		if args.serve:
+			if served:
+				raise ValueError("Serve mode cannot be nested")
+			return serve(sys.argv[1:] if argv is None else argv)
+		if served and (args.stdout or None in args.images):
+			raise ValueError("Standard input and output cannot be used for images in serve mode")
+
+		# 動画像の処理と組み合わせられないオプション
+		if args.sequence is not None and args.variant is not None:
+			raise ValueError("Variants cannot be combined with sequence mode")
+		if args.sequence is not None and args.max_memory is not None:
+			raise ValueError("Sequences cannot be rendered in bands with --max-memory")
+		if args.sequence == "frames" and args.stdout:
+			raise ValueError("Numbered frames cannot be sent to stdout")
 
 		# keep フラグの一括セット
 		if args.keep_all:
@@ -109,75 +148,287 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 			args.keep_yellow = True
 			args.keep_key = True
 
-		# ICC プロファイルを読み込む
-		if args.gray_profile is None:
-			gray_profile = default_gray_profile
-		else:
-			gray_profile = ImageCms.getOpenProfile(args.gray_profile)
-		if args.input_gray_profile is None:
-			in_gray_profile = default_gray_profile
-		else:
-			in_gray_profile = ImageCms.getOpenProfile(args.input_gray_profile)
-		if args.rgb_profile is None:
-			rgb_profile = default_rgb_profile
-		else:
-			rgb_profile = ImageCms.getOpenProfile(args.rgb_profile)
-		if args.input_rgb_profile is None:
-			in_rgb_profile = default_rgb_profile
-		else:
-			in_rgb_profile = ImageCms.getOpenProfile(args.input_rgb_profile)
-		if args.cmyk_profile is None:
-			cmyk_profile = default_cmyk_profile
-		else:
-			cmyk_profile = ImageCms.getOpenProfile(args.cmyk_profile)
-		if args.input_cmyk_profile is None:
-			in_cmyk_profile = default_cmyk_profile
-		else:
-			in_cmyk_profile = ImageCms.getOpenProfile(args.input_cmyk_profile)
-
-		# 色空間を変換する関数を作成する
-		if args.naive:
-			rgb_cmyk, cmyk_rgb = in_rgb_cmyk, in_cmyk_rgb = make_fake_transforms(args.key_from, args.gamma_correction)
-			gray_rgb = in_gray_rgb = lambda img: img.convert("RGB")
-			rgb_gray = in_rgb_gray = lambda img: img.convert("L")
-			gray_cmyk = in_gray_cmyk = lambda img: rgb_cmyk(gray_rgb(img))
-			cmyk_gray = in_cmyk_gray = lambda img: rgb_gray(cmyk_rgb(img))
-		else:
-			rgb_cmyk = make_profile_transform((rgb_profile, cmyk_profile), ("RGB", "CMYK"), args.cmyk_intent, not args.ignore)
-			cmyk_rgb = make_profile_transform((cmyk_profile, rgb_profile), ("CMYK", "RGB"), args.rgb_intent, not args.ignore)
-			in_rgb_cmyk = make_profile_transform((in_rgb_profile, cmyk_profile), ("RGB", "CMYK"), args.cmyk_intent, not args.ignore)
-			in_cmyk_rgb = make_profile_transform((in_cmyk_profile, rgb_profile), ("CMYK", "RGB"), args.rgb_intent, not args.ignore)
-			gray_rgb = make_profile_transform((gray_profile, rgb_profile), ("L", "RGB"), args.rgb_intent, not args.ignore)
-			rgb_gray = make_profile_transform((rgb_profile, gray_profile), ("RGB", "L"), args.gray_intent, not args.ignore)
-			in_gray_rgb = make_profile_transform((in_gray_profile, rgb_profile), ("L", "RGB"), args.rgb_intent, not args.ignore)
-			in_rgb_gray = make_profile_transform((in_rgb_profile, gray_profile), ("RGB", "L"), args.gray_intent, not args.ignore)
-			gray_cmyk = make_profile_transform((gray_profile, cmyk_profile), ("L", "CMYK"), args.cmyk_intent, not args.ignore)
-			cmyk_gray = make_profile_transform((cmyk_profile, gray_profile), ("CMYK", "L"), args.gray_intent, not args.ignore)
-			in_gray_cmyk = make_profile_transform((in_gray_profile, cmyk_profile), ("L", "CMYK"), args.cmyk_intent, not args.ignore)
-			in_cmyk_gray = make_profile_transform((in_cmyk_profile, gray_profile), ("CMYK", "L"), args.gray_intent, not args.ignore)
+		# 入力ファイルの内容と出力に影響するパラメータで変換済みのファイルを照合するマニフェストを開く
+		if args.manifest is not None and job is None and not args.stdout and not nofile and not callable(refout):
+			manifest = Manifest(args.manifest)
+			profiles = [args.gray_profile, args.input_gray_profile, args.rgb_profile, args.input_rgb_profile, args.cmyk_profile, args.input_cmyk_profile]
+			params = {
+				"version": version,
+				"options": {k: getattr(args, k) for k in manifest_options},
+				"profiles": [None if p is None else file_digest(p) for p in profiles],
+			}
+
+		# 処理の段階ごとの統計を記録する準備をする（cProfile は親プロセスでのみ使う）
+		instrumented = args.stats or args.stats_json is not None or args.profile is not None
+		if instrumented:
+			if job is None:
+				report = []
+				if args.profile is not None:
+					profiler = cProfile.Profile()
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+				tracing = True
+
+		# 連番のファイル名では入力の順番も出力に影響する
+		def manifest_params(i):
+			return value_digest([params, i]) if args.enumerate is not False else value_digest(params)
+
+		# 色空間の変換と網点化の設定を保持する変換器を作成する
+		if cache is None:
+			cache = TransformCache()
+		# 網点の配置のキャッシュは使い回せる場合（複数のファイル、変種、シーケンス、常駐）だけ使い、--max-memory の上限を超えないようにする
+		reusable = served or job is not None or args.glob or args.variant is not None or args.sequence is not None or len(args.images) + len(inputs or []) > 1
+		if geometry_cache is None and reusable:
+			geometry_cache = GeometryCache()
+		if geometry_cache is not None:
+			geometry_cache.max_memory = args.geometry_cache * 2 ** 20 if args.max_memory is None else min(args.geometry_cache, args.max_memory) * 2 ** 20
+		converter = Converter(
+			pitch=args.pitch,
+			scale=args.scale,
+			blur=args.blur,
+			blur_radius=args.blur_radius,
+			resample=args.resample,
+			engine=args.engine,
+			quality=args.quality,
+			gray_angle=args.gray_angle,
+			rgb_angles=args.rgb_angles,
+			cmyk_angles=args.cmyk_angles,
+			mode=args.mode,
+			output=args.output,
+			tiff=args.tiff,
+			gray_profile=args.gray_profile,
+			input_gray_profile=args.input_gray_profile,
+			rgb_profile=args.rgb_profile,
+			input_rgb_profile=args.input_rgb_profile,
+			cmyk_profile=args.cmyk_profile,
+			input_cmyk_profile=args.input_cmyk_profile,
+			gray_intent=args.gray_intent,
+			rgb_intent=args.rgb_intent,
+			cmyk_intent=args.cmyk_intent,
+			orientation=args.orientation,
+			ignore_embedded=args.ignore,
+			discard_profile=args.discard,
+			opaque=args.opaque,
+			naive=args.naive,
+			gamma_correction=args.gamma_correction,
+			key_from=args.key_from,
+			naive_lut=args.naive_lut,
+			keep=[c for c in ["red", "green", "blue", "cyan", "magenta", "yellow", "key"] if getattr(args, f"keep_{c}")],
+			workers=args.jobs if job is None else 1,
+			max_memory=None if args.max_memory is None else args.max_memory * 2 ** 20,
+			cache=cache,
+			geometry_cache=False if geometry_cache is None else geometry_cache,
+		)
+		# 網点化の設定を変えた変種の変換器（変種が無ければ変換器だけ）
+		variants = [converter] if args.variant is None else [converter.derive(**settings) for settings in args.variant]
+		# 1 つの入力から番号を付けた複数の出力を作るか
+		numbered = args.variant is not None or args.sequence == "frames"
+
+		# 出力ファイルを作成して開く関数
+		# マルチページの TIFF は書き込んだ内容を読み返しながら保存するので読み書きできるように開く
+		def open_output(fname, i, fmt, k=None, frame=None):
+			# 出力ディレクトリを作る
+			mkdirp(args.directory)
+			# 並列処理のワーカーでは一時ファイルへ書き込み、ファイル名は親プロセスが入力の順に付ける
+			if job is not None:
+				path = os.path.join(args.directory, f".halftonecv-{uuid4().hex}.part")
+				job.outputs.append((fmt, path))
+				return path, open(path, "x+b")
+			if args.enumerate is False:
+				name = args.prefix + purefilename(fname) + args.suffix
+			else:
+				name = args.prefix + f"{args.enumerate + i}" + args.suffix
+			# 変種と連番のフレームは番号を付けて区別する
+			if k is not None:
+				name += f"-{k + 1}"
+			if frame is not None:
+				name += f"-{frame + 1:04d}"
+			path = filepath(args.directory, name, fmt.lower())
+			while True:
+				try:
+					return path, open(path, "w+b" if args.force else "x+b")
+				except FileExistsError:
+					path = altfilepath(path, suffix="+")
+
+		# 1 つのファイルの統計を記録して表示する関数（並列処理のワーカーでは親プロセスへ返す）
+		def record_stats(fname, path, dt, data):
+			if job is not None:
+				job.stats = data
+				return
+			report.append({"file": fname, "output": path, "sec": dt, **data})
+			if args.stats:
+				for line in format_table(data):
+					eprint(line)
+
+		# 並列処理のワーカーが書き出した一時ファイルに出力ファイル名を付ける関数
+		def place_outputs(parts, fname, i):
+			paths = []
+			try:
+				for k, (fmt, part) in enumerate(parts):
+					path, fp = open_output(fname, i, fmt, None if args.variant is None else k, k if args.sequence == "frames" else None)
+					fp.close()
+					os.replace(part, path)
+					paths.append(path)
+			except BaseException:
+				for fmt, part in parts[len(paths):]:
+					with contextlib.suppress(OSError):
+						os.remove(part)
+				raise
+			return paths
+
+		# 標準出力のパイプが閉じられたときに以降の出力を捨てる関数
+		def discard_stdout():
+			nonlocal broken_pipe, exit_code
+			broken_pipe = True
+			exit_code = 128 + 13
+			devnull = os.open(os.devnull, os.O_WRONLY)
+			os.dup2(devnull, sys.stdout.fileno())
+
+		# 出力モードの画像を保存する関数（params は保存時の追加の引数）
+		def write_output(complete, fmt, fname, i, k=None, frame=None, **params):
+			path = None
+			with stage("save"):
+				# 参照渡しで返す
+				if callable(refout):
+					buf = io.BytesIO()
+					complete.save(buf, format=fmt, **params)
+					refout(buf.getvalue())
+				# 標準出力へ流す
+				if args.stdout:
+					path = f"(stdout) [{fmt}]"
+					try:
+						with io.BytesIO() as buf:
+							complete.save(buf, format=fmt, **params)
+							sys.stdout.buffer.write(buf.getbuffer())
+					except BrokenPipeError:
+						discard_stdout()
+				# ファイルへ保存する
+				elif not nofile:
+					path, fp = open_output(fname, i, fmt, k, frame)
+					with fp:
+						complete.save(fp, format=fmt, **params)
+			return path
+
+		# 網点化した画像を出力モードへ変換して保存する関数
+		def save_output(halftone, same, alpha, fname, i, variant, k):
+			# 目的の出力モードへ変換してアルファチャンネルを再合成する
+			complete = variant.finish(halftone, same, alpha)
+			return write_output(complete, variant.output_format(complete.mode), fname, i, k)
+
+		# 動画像の全フレームを網点化して保存する関数
+		# フレームの読み込みと色空間の変換、網点化、出力を別々のスレッドで並行して行い、網点の中心の座標はフレームの間で使い回す
+		def save_sequence(img, fname, i, frame_callback):
+			count = getattr(img, "n_frames", 1)
+			paths = []
+			frames = []
+			durations = []
+			# フレームを順に読み込んでハーフトーンの色空間へ変換する（次のフレームを読み込むと書き換わるので複製する）
+			def decode():
+				for frame in ImageSequence.Iterator(img):
+					yield (*converter.prepare(frame.copy()), frame.info.get("duration"))
+			# 網点化したフレームを出力モードへ変換して保存するか、動画像にまとめるために溜める
+			def encode(j, halftone, same, alpha, duration):
+				complete = converter.finish(halftone, same, alpha)
+				if args.sequence == "frames":
+					paths.append(write_output(complete, converter.output_format(complete.mode), fname, i, frame=j))
+				else:
+					frames.append(complete)
+					durations.append(duration)
+			states = None
+			encoder = pipelined(encode)
+			try:
+				for j, (target, same, alpha, duration) in enumerate(timed("decode", prefetch(decode()))):
+					region = converter.clip_region(target, args.region)
+					if alpha is not None and region is not None and not args.opaque:
+						alpha = resize_alpha(alpha, converter.output_size(target), region)
+					with stage("halftone"):
+						halftone, states = converter.halftone_frame(target, None, region, states, args.frame_threshold)
+					encoder.submit(j, halftone, same, alpha, duration)
+					if frame_callback is not None:
+						frame_callback((j + 1) / count)
+			finally:
+				encoder.join()
+			if args.sequence == "frames":
+				return paths
+			# 動画像として保存する（PNG は APNG、TIFF はマルチページ）
+			fmt = converter.output_format(frames[0].mode)
+			params = {"save_all": True, "append_images": frames[1:]}
+			if fmt == "PNG" and any(d is not None for d in durations):
+				params.update(duration=[d or 0 for d in durations], loop=img.info.get("loop", 0))
+			return [write_output(frames[0], fmt, fname, i, **params)]
+
+		# 帯状に網点化した画像を出力モードへ変換しながら逐次保存する関数
+		# size は出力画像全体の大きさ、region は出力する矩形 (left, top, width, height)
+		def stream_output(bands, size, region, same, alpha, fname, i, variant, k):
+			path = None
+			fps = []
+			writer = None
+			try:
+				for top, halftone in bands:
+					# 帯に対応するアルファチャンネルを切り出す
+					band_alpha = None
+					if alpha is not None and not args.opaque:
+						band_alpha = resize_alpha(alpha, size, (region[0], region[1] + top, *halftone.size))
+					band = variant.finish(halftone, same, band_alpha)
+					# 最初の帯の形式に合わせて出力先を開く
+					if writer is None:
+						fmt = variant.output_format(band.mode)
+						icc_profile = band.info.get("icc_profile")
+						if callable(refout):
+							buf = io.BytesIO()
+							fps.append(buf)
+						if args.stdout:
+							path = f"(stdout) [{fmt}]"
+							fps.append(sys.stdout.buffer)
+						elif not nofile:
+							path, fp = open_output(fname, i, fmt, k)
+							fps.append(fp)
+						writer = make_stream_writer(tee(*fps), fmt, band.mode, region[2:], icc_profile)
+					with stage("save"):
+						writer(band)
+			except BrokenPipeError:
+				discard_stdout()
+			except BaseException:
+				# 書きかけのファイルを削除する
+				if not args.stdout and not nofile and path is not None:
+					fps[-1].close()
+					os.remove(path)
+				raise
+			finally:
+				for fp in fps:
+					if fp is not sys.stdout.buffer and not isinstance(fp, io.BytesIO):
+						fp.close()
+			if callable(refout) and writer is not None:
+				refout(fps[0].getvalue())
+			return path
 
 		# ピクセル数の制限を無くす
 		if args.allow_huge:
 			Image.MAX_IMAGE_PIXELS = None
 
-		# 処理対象ファイルをリスティング
-		images = [i for i in args.images if i is not None]
-		if args.glob:
-			input_images = []
-			for i in images:
-				input_images += [f for f in glob(i, recursive=True) if isfile(f)]
-			input_images = list(dict.fromkeys(input_images))
+		# 処理対象ファイルをリスティング（並列処理のワーカーは親プロセスから渡されたファイルだけを処理する）
+		if job is not None:
+			input_images = list(inputs)
 		else:
-			input_images = images
-		if None in args.images:
-			input_images = [None] + input_images
-		if inputs is not None:
-			input_images = list(inputs) + input_images
+			images = [i for i in args.images if i is not None]
+			if args.glob:
+				input_images = []
+				for i in images:
+					input_images += [f for f in glob(i, recursive=True) if isfile(f)]
+				input_images = list(dict.fromkeys(input_images))
+			else:
+				input_images = images
+			if None in args.images:
+				input_images = [None] + input_images
+			if inputs is not None:
+				input_images = list(inputs) + input_images
 		n = len(input_images)
 
 		# 複数の処理ファイルと stdout への出力が指定されている場合はエラー
 		if args.stdout and n > 1:
 			raise ValueError("Multiple input files cannot be processed when output is set to stdout")
+		if args.stdout and len(variants) > 1:
+			raise ValueError("Multiple variants cannot be processed when output is set to stdout")
 
 		# 処理対象のファイル数を表示
 		if not args.quiet:
@@ -188,199 +439,160 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 			else:
 				eprint(f"{n} processing targets have been queued")
 
+		# 進捗の表示の設定
+		cols = (
+			TextColumn("[progress.description]{task.description}"),
+			BarColumn(bar_width=50),
+			TaskProgressColumn(),
+		)
+
+		# 複数のファイルをプロセスプールで並列に処理して入力の順に報告する
+		if args.jobs > 1 and n > 1 and job is None and not callable(refout) and not nofile and all(isinstance(f, str) for f in input_images):
+			worker_argv = ["-q", *(sys.argv[1:] if argv is None else argv)]
+			with contextlib.nullcontext(None) if args.quiet else Progress(*cols, console=console) as progress:
+				# ファイルごとにチャンネルの進捗を平均して表示する
+				tasks = {}
+				if progress is not None:
+					total = progress.add_task("Total", total=n)
+				def update(i, event):
+					if progress is not None:
+						channel, count, p = event
+						if i not in tasks:
+							tasks[i] = progress.add_task(escape(os.path.basename(input_images[i])), total=1.0), {}
+						t, done = tasks[i]
+						done[channel] = p
+						progress.update(t, completed=sum(done.values()) / count)
+				def discard(result):
+					for fmt, part in result[0]:
+						with contextlib.suppress(OSError):
+							os.remove(part)
+				# 出力が最新のファイルは投入しない（照合に失敗したファイルはワーカーでエラーを報告させる）
+				skips = {}
+				if manifest is not None:
+					for i, f in enumerate(input_images):
+						with contextlib.suppress(OSError):
+							current = manifest.lookup(f, manifest_params(i))
+							if current is not None:
+								skips[i] = current
+				jobs = [(i, f) for i, f in enumerate(input_images) if i not in skips]
+				results = imap_ordered(run_batch_job, jobs, args.jobs, update, initialize_batch_worker, (worker_argv,), discard=discard)
+				with contextlib.closing(results):
+					for i, fname in enumerate(input_images):
+						if i in skips:
+							if not args.quiet:
+								eprint(f"{i + 1}/{n} skipped: {fname} -> {skips[i]} (up to date)")
+							if progress is not None:
+								progress.advance(total)
+							continue
+						try:
+							parts, dt, data = next(results).result()
+							paths = place_outputs(parts, fname, i)
+							path = ", ".join(paths)
+							if manifest is not None:
+								manifest.record(fname, manifest_params(i), paths if numbered else paths[0])
+						# エラーを報告する
+						except Exception as e:
+							eprint(f"{i + 1}/{n} error: {fname}")
+							if args.traceback:
+								console.print_exception()
+							else:
+								eprint(e)
+							exit_code = 1
+							if args.exit:
+								return exit_code
+						# 成功を報告する
+						else:
+							if not args.quiet:
+								eprint(f"{i + 1}/{n} done: {fname} -> {path} ({dt:.1f} sec)")
+							if data is not None:
+								record_stats(fname, path, dt, data)
+						finally:
+							if progress is not None:
+								if i in tasks:
+									progress.remove_task(tasks.pop(i)[0])
+								progress.advance(total)
+			return exit_code
+
 		# 処理のメインループ
 		for i, f in enumerate(input_images):
 			stime = time()
+			file_stats = Stats(profile=args.profile, profiler=profiler) if instrumented else None
+			previous_stats = activate(file_stats)
 			try:
-				# 画像を開く
-				if isinstance(f, bytes):
-					fname = f"(kwargs[{i}])"
-					buf = io.BytesIO(f)
-					img = Image.open(buf)
-				elif f is None:
-					fname = "(stdin)"
-					buf = io.BytesIO(sys.stdin.buffer.read())
-					img = Image.open(buf)
-				else:
+				# 出力が最新ならスキップする
+				if manifest is not None and isinstance(f, str):
 					fname = f
-					img = Image.open(f)
-				if args.orientation:
-					img = exif_transpose(img)
-				alpha = None
-				if img.mode == "LA":
-					alpha = img.split()[1]
-					img = img.convert("L")
-				elif img.mode == "RGBA":
-					alpha = img.split()[3]
-					img = img.convert("RGB")
-				elif img.mode == "P":
-					rgba = img.convert("RGBA")
-					alpha = rgba.split()[3]
-					img = rgba.convert("RGB")
-				if img.mode not in ["L", "RGB", "CMYK"]:
-					raise ValueError("unsupported image type")
-				# ハーフトーンの色空間へ変換する
-				if img.mode == "L":
-					if args.mode == "gray":
-						target, same = img, True
-					elif args.mode == "rgb":
-						target, same = in_gray_rgb(img), False
-					elif args.mode == "cmyk":
-						target, same = in_gray_cmyk(img), False
-					else:
-						target, same = img, True
-				elif img.mode == "RGB":
-					if args.mode == "gray":
-						target, same = in_rgb_gray(img), False
-					elif args.mode == "rgb":
-						target, same = img, True
-					elif args.mode == "cmyk":
-						target, same = in_rgb_cmyk(img), False
-					else:
-						target, same = in_rgb_cmyk(img), False
-				elif img.mode == "CMYK":
-					if args.mode == "gray":
-						target, same = in_cmyk_gray(img), False
-					elif args.mode == "rgb":
-						target, same = in_cmyk_rgb(img), False
-					elif args.mode == "cmyk":
-						target, same = img, True
+					current = manifest.lookup(f, manifest_params(i))
+					if current is not None:
+						if not args.quiet:
+							eprint(f"{i + 1}/{n} skipped: {fname} -> {current} (up to date)")
+						continue
+				# 画像を開く
+				with stage("open"):
+					if isinstance(f, bytes):
+						fname = f"(kwargs[{i}])"
+						buf = io.BytesIO(f)
+						img = Image.open(buf)
+					elif f is None:
+						fname = "(stdin)"
+						buf = io.BytesIO(sys.stdin.buffer.read())
+						img = Image.open(buf)
 					else:
-						target, same = img, True
-				# ハーフトーン化
-				blur = None if args.blur is None else (args.blur, args.blur_radius)
-				cols = (
-					TextColumn("[progress.description]{task.description}"),
-					BarColumn(bar_width=50),
-					TaskProgressColumn(),
-				)
-				with contextlib.nullcontext(None) if args.quiet else Progress(*cols, console=console) as progress:
-					if target.mode == "L":
-						if progress is None:
+						fname = f
+						img = Image.open(f)
+					img.load()
+				# 動画像の全フレームを網点化して出力する
+				if args.sequence is not None:
+					with contextlib.nullcontext(None) if args.quiet else Progress(*cols, console=console) as progress:
+						if job is not None:
+							fn = relay_callback(job.index, 0, 1)
+						elif progress is None:
 							fn = None
 						else:
-							t = progress.add_task("Gray", total=1.0)
-							fn = lambda p: progress.update(t, completed=p)
-						halftone = halftone_grayscale_image(target, args.pitch, args.gray_angle, args.scale, blur, args.resample, progress_callback=fn)
-					elif target.mode == "RGB":
-						if progress is None:
-							fns = (None, None, None)
-						else:
-							r = progress.add_task("[red]Red", total=1.0)
-							g = progress.add_task("[green]Green", total=1.0)
-							b = progress.add_task("[blue]Blue", total=1.0)
-							fns = (
-								lambda p: progress.update(r, completed=p),
-								lambda p: progress.update(g, completed=p),
-								lambda p: progress.update(b, completed=p),
-							)
-						halftone = halftone_rgb_image(target, args.pitch, args.rgb_angles, args.scale, blur, args.resample, (args.keep_red, args.keep_green, args.keep_blue), progress_callbacks=fns)
-					elif target.mode == "CMYK":
-						if progress is None:
-							fns = (None, None, None, None)
-						else:
-							c = progress.add_task("[cyan]Cyan", total=1.0)
-							m = progress.add_task("[magenta]Magenta", total=1.0)
-							y = progress.add_task("[yellow]Yellow", total=1.0)
-							k = progress.add_task("Key", total=1.0)
-							fns = (
-								lambda p: progress.update(c, completed=p),
-								lambda p: progress.update(m, completed=p),
-								lambda p: progress.update(y, completed=p),
-								lambda p: progress.update(k, completed=p),
-							)
-						halftone = halftone_cmyk_image(target, args.pitch, args.cmyk_angles, args.scale, blur, args.resample, (args.keep_cyan, args.keep_magenta, args.keep_yellow, args.keep_key), progress_callbacks=fns)
-				# 目的の出力モードへ変換する
-				if halftone.mode == "L":
-					if args.output == "gray":
-						complete = halftone
-					elif args.output == "rgb":
-						complete = in_gray_rgb(halftone) if same else gray_rgb(halftone)
-					elif args.output == "cmyk":
-						complete = in_gray_cmyk(halftone) if same else gray_cmyk(halftone)
-					else:
-						complete = halftone
-				elif halftone.mode == "RGB":
-					if args.output == "gray":
-						complete = in_rgb_gray(halftone) if same else rgb_gray(halftone)
-					elif args.output == "rgb":
-						complete = halftone
-					elif args.output == "cmyk":
-						complete = in_rgb_cmyk(halftone) if same else rgb_cmyk(halftone)
-					else:
-						complete = halftone
-				elif halftone.mode == "CMYK":
-					if args.output == "gray":
-						complete = in_cmyk_gray(halftone) if same else cmyk_gray(halftone)
-					elif args.output == "rgb":
-						complete = in_cmyk_rgb(halftone) if same else cmyk_rgb(halftone)
-					elif args.output == "cmyk":
-						complete = halftone
-					else:
-						complete = in_cmyk_rgb(halftone) if same else cmyk_rgb(halftone)
-				# アルファチャンネルを再合成する
-				if alpha is not None and not args.opaque:
-					if complete.mode in ["RGB", "L"]:
-						width, height = complete.size
-						if (width, height) != alpha.size:
-							alpha = alpha.resize((width, height), Resampling.LANCZOS)
-						complete = Image.merge(complete.mode + "A", (*complete.split(), alpha))
-						# 透明ピクセルの色を平坦化
-						if complete.mode == "RGBA":
-							transparent = (255, 255, 255, 0)
-							bg = Image.new("RGBA", complete.size, transparent)
-							complete = Image.alpha_composite(bg, complete)
-				# 必要なら ICC プロファイルを廃棄する
-				if args.discard:
-					if complete.info.get("icc_profile"):
-						complete.info.pop("icc_profile")
-				# 参照渡しで返す
-				if callable(refout):
-					buf = io.BytesIO()
-					complete.save(buf, format=("TIFF" if complete.mode == "CMYK" or args.tiff else "PNG"))
-					refout(buf.getvalue())
-				# 標準出力へ流す
-				if args.stdout:
-					name = "(stdout)"
-					if complete.mode == "CMYK" or args.tiff:
-						path = f"{name} [TIFF]"
-						fmt = "TIFF"
-					else:
-						path = f"{name} [PNG]"
-						fmt = "PNG"
-					try:
-						with io.BytesIO() as buf:
-							complete.save(buf, format=fmt)
-							sys.stdout.buffer.write(buf.getbuffer())
-					except BrokenPipeError:
-						broken_pipe = True
-						exit_code = 128 + 13
-						devnull = os.open(os.devnull, os.O_WRONLY)
-						os.dup2(devnull, sys.stdout.fileno())
-				# ファイルへ保存する
-				elif not nofile:
-					# 出力ディレクトリを作る
-					mkdirp(args.directory)
-					if args.enumerate is False:
-						name = args.prefix + purefilename(fname) + args.suffix
-					else:
-						name = args.prefix + f"{args.enumerate + i}" + args.suffix
-					if complete.mode == "CMYK" or args.tiff:
-						fmt = "TIFF"
-						path = filepath(args.directory, name, "tiff")
-					else:
-						fmt = "PNG"
-						path = filepath(args.directory, name, "png")
-					while True:
-						try:
-							with open(path, "wb" if args.force else "xb") as fp:
-								complete.save(fp, format=fmt)
-							break
-						except FileExistsError:
-							path = altfilepath(path, suffix="+")
+							fn = progress_callback(progress, progress.add_task("Frames", total=1.0))
+						paths = save_sequence(img, fname, i, fn)
+				else:
+					# 向きを補正してアルファチャンネルを分離し、ハーフトーンの色空間へ変換する
+					target, same, alpha = converter.prepare(img)
+					# 変種ごとにハーフトーン化して出力する（変種の間ではぼかしとリサンプリング用の配列を共有する）
+					names = channel_labels[target.mode]
+					paths = []
+					with sharing() if len(variants) > 1 else contextlib.nullcontext():
+						for k, derived in enumerate(variants):
+							index = None if args.variant is None else k
+							# 出力する矩形とそれに対応するアルファチャンネル
+							size = derived.output_size(target)
+							region = derived.clip_region(target, args.region)
+							cropped = alpha
+							if alpha is not None and region is not None and not args.opaque:
+								cropped = resize_alpha(alpha, size, region)
+							with stage("halftone"), contextlib.nullcontext(None) if args.quiet else Progress(*cols, console=console) as progress:
+								if job is not None:
+									fns = tuple(relay_callback(job.index, k * len(names) + c, len(names) * len(variants)) for c in range(len(names)))
+								elif progress is None:
+									fns = (None,) * len(names)
+								else:
+									label = "" if index is None else f" #{k + 1}"
+									fns = tuple(progress_callback(progress, progress.add_task(name + label, total=1.0)) for name in names)
+								# 帯状に網点化しながら逐次出力する
+								if derived.max_memory is not None:
+									bands = derived.halftone_bands(target, fns, region)
+									paths.append(stream_output(bands, size, region or (0, 0, *size), same, alpha, fname, i, derived, index))
+								else:
+									halftone = derived.halftone(target, fns, region=region)
+							# 出力する
+							if derived.max_memory is None:
+								paths.append(save_output(halftone, same, cropped, fname, i, derived, index))
+								halftone = None
+				path = paths[0] if len(paths) == 1 else ", ".join(str(p) for p in paths)
+				# マニフェストに記録する
+				if manifest is not None and isinstance(f, str) and None not in paths:
+					manifest.record(f, manifest_params(i), paths if numbered else paths[0])
 
-			# エラーを報告する
+			# エラーを報告する（並列処理のワーカーでは親プロセスへ送る）
 			except Exception as e:
+				if job is not None:
+					raise
 				eprint(f"{i + 1}/{n} error: {fname}")
 				if args.traceback:
 					console.print_exception()
@@ -397,9 +609,15 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 						eprint(f"{i + 1}/{n} sigpipe: {fname} -> {path} ({dt:.1f} sec)")
 					else:
 						eprint(f"{i + 1}/{n} done: {fname} -> {path} ({dt:.1f} sec)")
+				if file_stats is not None:
+					record_stats(fname, path, dt, file_stats.as_dict())
+			finally:
+				activate(previous_stats)
 		return exit_code
 
 	except ValueError as e:
+		if job is not None:
+			raise
 		try:
 			if args.traceback:
 				console.print_exception()
@@ -416,3 +634,124 @@ def main(*, argv=None, inputs=None, refout=None, nofile=False, notrap=False):
 		eprint("KeyboardInterrupt")
 		exit_code = 128 + 2
 		return exit_code
+
+	# マニフェストを書き出して照合の結果を報告する
+	finally:
+		if manifest is not None:
+			manifest.save()
+			if not args.quiet:
+				eprint(f"Manifest: {manifest.hits} up to date, {manifest.misses} processed")
+		# 統計とキャッシュのヒット率を出力する
+		if tracing:
+			tracemalloc.stop()
+		if report is not None:
+			caches = cache_stats(cache, manifest, geometry_cache)
+			if args.stats:
+				for name, entry in caches.items():
+					lookups = entry["hits"] + entry["misses"]
+					ratio = f"{entry['hits'] / lookups:.1%}" if lookups > 0 else "-"
+					eprint(f"Cache {name}: {entry['hits']} hits, {entry['misses']} misses ({ratio})")
+			if args.stats_json is not None:
+				with open(args.stats_json, "w") as fp:
+					json.dump({"files": report, "caches": caches}, fp, indent=2)
+					print(file=fp)
+		if profiler is not None:
+			if args.profile_output is None:
+				pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+			else:
+				profiler.dump_stats(args.profile_output)
+
+# 進捗の表示に使うチャンネルの名前
+channel_labels = {
+	"L": ("Gray",),
+	"RGB": ("[red]Red", "[green]Green", "[blue]Blue"),
+	"CMYK": ("[cyan]Cyan", "[magenta]Magenta", "[yellow]Yellow", "Key"),
+}
+
+# キャッシュのヒット数とミス数を返す
+def cache_stats(cache, manifest=None, geometry_cache=None):
+	caches = {"transform": {"hits": cache.hits, "misses": cache.misses}}
+	if geometry_cache is not None:
+		caches["geometry"] = {"hits": geometry_cache.hits, "misses": geometry_cache.misses}
+	for name, fn in [("radius_table", load_radius_table), ("radius", make_radius), ("resampler", get_resampler), ("coverage_stamp", coverage_stamp)]:
+		info = fn.cache_info()
+		caches[name] = {"hits": info.hits, "misses": info.misses}
+	if manifest is not None:
+		caches["manifest"] = {"hits": manifest.hits, "misses": manifest.misses}
+	return caches
+
+# 出力に影響するオプション（マニフェストの照合に使う）
+manifest_options = [
+	"directory", "prefix", "suffix", "enumerate", "pitch", "scale", "blur", "blur_radius", "engine", "quality", "resample",
+	"gray_angle", "rgb_angles", "cmyk_angles", "mode", "output", "tiff", "gray_intent", "rgb_intent", "cmyk_intent",
+	"orientation", "ignore", "discard", "opaque", "naive", "gamma_correction", "key_from",
+	"keep_red", "keep_green", "keep_blue", "keep_cyan", "keep_magenta", "keep_yellow", "keep_key", "variant", "region",
+	"sequence", "frame_threshold",
+]
+
+# 進捗表示のタスクを更新するコールバックを返す
+def progress_callback(progress, task):
+	return lambda p: progress.update(task, completed=p)
+
+# 並列処理のワーカーから親プロセスへチャンネルの進捗を送るコールバックを返す
+def relay_callback(index, channel, count):
+	return lambda p: report_progress(index, (channel, count, p))
+
+# 並列処理のワーカープロセスで共有する引数と ICC 変換のキャッシュ
+batch_worker = None
+
+# 並列処理のワーカープロセスの初期化関数
+def initialize_batch_worker(argv):
+	global batch_worker
+	batch_worker = SimpleNamespace(argv=argv, cache=TransformCache(), geometry_cache=GeometryCache())
+
+# ワーカープロセスで 1 つの入力ファイルを網点化して一時ファイルへ書き出し、形式と一時ファイルのパスと処理時間を返す
+def run_batch_job(index, f):
+	stime = time()
+	job = SimpleNamespace(index=index, outputs=[], stats=None)
+	try:
+		main(argv=batch_worker.argv, inputs=[f], cache=batch_worker.cache, geometry_cache=batch_worker.geometry_cache, notrap=True, job=job)
+	except BaseException:
+		for fmt, part in job.outputs:
+			with contextlib.suppress(OSError):
+				os.remove(part)
+		raise
+	return job.outputs, time() - stime, job.stats
+
+# 標準入力の JSON Lines で受け取ったジョブを ICC 変換と網点の配置のキャッシュを共有しながら処理し続ける
+def serve(argv):
+	base = [a for a in argv if a != "--serve"]
+	cache = TransformCache()
+	geometry_cache = GeometryCache()
+	for line in sys.stdin:
+		if not line.strip():
+			continue
+		# ジョブは引数のリストか、id と args を持つオブジェクト
+		try:
+			job = json.loads(line)
+			if isinstance(job, list):
+				job = {"args": job}
+			job_id = job.get("id")
+			job_args = job.get("args", [])
+			if not isinstance(job_args, list) or not all(isinstance(a, str) for a in job_args):
+				raise ValueError("'args' must be a list of strings")
+		except (ValueError, AttributeError) as e:
+			response = {"id": None, "exit_code": 2, "error": str(e)}
+		else:
+			# ジョブの失敗でサーバーを止めず、エラーを応答して次のジョブへ進む
+			try:
+				exit_code = main(argv=base + job_args, cache=cache, geometry_cache=geometry_cache, served=True, notrap=True)
+			except SystemExit as e:
+				exit_code = e.code if isinstance(e.code, int) else 2
+			except Exception as e:
+				exit_code = None
+				response = {"id": job_id, "exit_code": 1, "error": str(e)}
+			if exit_code is not None:
+				response = {
+					"id": job_id,
+					"exit_code": exit_code,
+					"transform_cache": {"hits": cache.hits, "misses": cache.misses},
+					"geometry_cache": {"hits": geometry_cache.hits, "misses": geometry_cache.misses},
+				}
+		print(json.dumps(response), flush=True)
+	return 0
@@ -11,6 +11,14 @@ def positive(str):
 	else:
 		raise ValueError()
 
+# 正の整数を受け入れる変換関数
+def natural(str):
+	value = int(str)
+	if value >= 1:
+		return value
+	else:
+		raise ValueError()
+
 # 0-1 の実数を受け入れる変換関数
 def rate(str):
 	value = float(str)
@@ -59,3 +67,38 @@ def intent(label):
 		return int(label)
 	else:
 		raise ValueError()
+
+# 変種の設定（key=value をカンマで区切ったもの、角度はコロンで区切る）を受け入れて辞書で返す変換関数
+def variant(label):
+	keys = {
+		"pitch": ("pitch", positive),
+		"scale": ("scale", positive),
+		"blur": ("blur", lambda v: {"box": "box", "gaussian": "gaussian"}[v.lower()]),
+		"blur-radius": ("blur_radius", positive),
+		"resample": ("resample", lambda v: {k: k for k in ["nearest", "linear", "lanczos2", "lanczos3", "spline36", "area"]}[v.lower()]),
+		"engine": ("engine", lambda v: {"cairo": "cairo", "numpy": "numpy", "screen": "screen"}[v.lower()]),
+		"quality": ("quality", lambda v: {"draft": "draft", "normal": "normal", "best": "best"}[v.lower()]),
+		"angle": ("gray_angle", float),
+		"rgb-angles": ("rgb_angles", lambda v: angles(v, 3)),
+		"angles": ("cmyk_angles", lambda v: angles(v, 4)),
+	}
+	settings = {}
+	for item in label.split(","):
+		key, sep, value = item.partition("=")
+		key = key.strip().lower()
+		if not sep or key not in keys:
+			raise ValueError()
+		name, convert = keys[key]
+		try:
+			settings[name] = convert(value.strip())
+		except KeyError:
+			raise ValueError() from None
+	return settings
+
+# コロンで区切った n 個の角度を受け入れる変換関数
+def angles(label, n):
+	values = tuple(float(v) for v in label.split(":"))
+	if len(values) == n:
+		return values
+	else:
+		raise ValueError()
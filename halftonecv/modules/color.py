@@ -1,22 +1,77 @@
 import io
+import hashlib
+import threading
 import numpy as np
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
 from sys import float_info
 from PIL import Image, ImageCms
 
+# 構築済みの ICC 変換をプロファイルのハッシュ、モード、インテントごとに保持するキャッシュ
+class TransformCache:
+	def __init__(self, maxsize=64):
+		self.maxsize = maxsize
+		self.transforms = OrderedDict()
+		self.digests = WeakKeyDictionary()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	# プロファイルのハッシュ値を返す
+	# 変換の構築後はシリアライズ結果が変わりうるので、最初に見たときの値をオブジェクトごとに保持する
+	def digest(self, profile):
+		if isinstance(profile, bytes):
+			return hashlib.sha256(profile).hexdigest()
+		with self.lock:
+			value = self.digests.get(profile)
+		if value is None:
+			value = hashlib.sha256(profile.tobytes()).hexdigest()
+			with self.lock:
+				value = self.digests.setdefault(profile, value)
+		return value
+
+	# キーに対応する変換を返し、無ければ構築して保持する（複数のスレッドから呼ばれてもよい）
+	def fetch(self, key, build):
+		with self.lock:
+			transform = self.transforms.get(key)
+			if transform is not None:
+				self.hits += 1
+				self.transforms.move_to_end(key)
+				return transform
+			self.misses += 1
+		transform = build()
+		with self.lock:
+			transform = self.transforms.setdefault(key, transform)
+			self.transforms.move_to_end(key)
+			if len(self.transforms) > self.maxsize:
+				self.transforms.popitem(last=False)
+		return transform
+
 # プロファイル変換の関数を返す
-def make_profile_transform(profiles, modes, intent, prefer_embedded=True, *, lazy=True):
+def make_profile_transform(profiles, modes, intent, prefer_embedded=True, *, lazy=True, cache=None):
 	def build():
 		return ImageCms.buildTransform(*profiles, *modes, intent)
-	transform = None if lazy else build()
+	if cache is not None:
+		key = (cache.digest(profiles[0]), cache.digest(profiles[1]), *modes, intent)
+	def fetch():
+		if cache is None:
+			return build()
+		return cache.fetch(key, build)
+	transform = None if lazy else fetch()
 	def profile_conversion(image):
 		nonlocal transform
 		maybe_icc = image.info.get("icc_profile")
 		if not prefer_embedded or maybe_icc is None:
 			if transform is None:
-				transform = build()
+				transform = fetch()
 			return ImageCms.applyTransform(image, transform)
-		em_profile = ImageCms.ImageCmsProfile(io.BytesIO(maybe_icc))
-		return ImageCms.profileToProfile(image, em_profile, profiles[1], renderingIntent=intent, outputMode=modes[1])
+		if cache is None:
+			em_profile = ImageCms.ImageCmsProfile(io.BytesIO(maybe_icc))
+			return ImageCms.profileToProfile(image, em_profile, profiles[1], renderingIntent=intent, outputMode=modes[1])
+		# 埋め込みプロファイルからの変換もハッシュで再利用する
+		em_key = (cache.digest(maybe_icc), key[1], image.mode, modes[1], intent)
+		em_transform = cache.fetch(em_key, lambda: ImageCms.buildTransform(ImageCms.ImageCmsProfile(io.BytesIO(maybe_icc)), profiles[1], image.mode, modes[1], intent))
+		return ImageCms.applyTransform(image, em_transform)
 	return profile_conversion
 
 # sRGB のガンマ変換
@@ -52,31 +107,68 @@ def make_fake_conversions(k_threshold, gamma_correction):
 		return r, g, b
 	return rgb_2_cmyk, cmyk_2_rgb
 
+# sRGB のガンマ変換（配列版）
+def gamma_forward_array(u):
+	return np.where(u <= 0.0031308, 12.92 * u, 1.055 * np.maximum(u, 0) ** (1 / 2.4) - 0.055).astype(u.dtype)
+
+# sRGB の逆ガンマ変換（配列版）
+def gamma_reverse_array(u):
+	return np.where(u <= 0.04045, u / 12.92, ((u + 0.055) / 1.055) ** 2.4).astype(u.dtype)
+
+# sRGB と CMYK 間の色の近似的な変換関数（配列版）を返す
+# 配列の最後の軸を色の成分として [0, 1] の float32 で計算する
+def make_fake_array_conversions(k_threshold, gamma_correction):
+	def rgb_2_cmyk(rgb):
+		if gamma_correction:
+			rgb = gamma_reverse_array(rgb)
+		cmyk = np.empty(rgb.shape[:-1] + (4,), dtype=np.float32)
+		white = 1 - rgb.max(axis=-1)
+		if k_threshold < 1:
+			k = np.clip((white - k_threshold) / (1 - k_threshold), 0, 1)
+		else:
+			k = np.zeros_like(white)
+		cmyk[..., 3] = k
+		# 黒が 1 のときは CMY を 0 にする（float32 では k が 1 からずれるので、RGB の成分が無いことで判定する）
+		solid = white >= 1
+		denominator = np.where(solid, 1, 1 - k)[..., np.newaxis]
+		cmyk[..., :3] = np.where(solid[..., np.newaxis], 0, np.clip((1 - rgb - k[..., np.newaxis]) / denominator, 0, 1))
+		return cmyk
+	def cmyk_2_rgb(cmyk):
+		k = cmyk[..., 3:]
+		rgb = np.minimum(1, 1 - np.minimum(1, cmyk[..., :3] * (1 - k) + k))
+		if gamma_correction:
+			rgb = gamma_forward_array(rgb)
+		return rgb
+	return rgb_2_cmyk, cmyk_2_rgb
+
+# [0, 1] の配列を 8 ビットに量子化する
+def quantize(array):
+	return np.rint(array * 255).astype(np.uint8)
+
 # sRGB と CMYK 間の画像の近似的な変換関数を返す
-def make_fake_transforms(k_threshold=0.5, gamma_correction=True):
-	rgb2cmyk, cmyk2rgb = make_fake_conversions(k_threshold, gamma_correction)
-	rgb2cmyk_univ = np.frompyfunc(rgb2cmyk, 3, 4)
-	cmyk2rgb_univ = np.frompyfunc(cmyk2rgb, 4, 3)
+# lut が真なら sRGB から CMYK への変換を 256³ 色の 3 次元 LUT（64 MiB）を引く形で行う
+def make_fake_transforms(k_threshold=0.5, gamma_correction=True, lut=False, chunk_size=2 ** 20):
+	rgb2cmyk, cmyk2rgb = make_fake_array_conversions(k_threshold, gamma_correction)
+	table = None
+	def convert(array, fn, channels):
+		flat = array.reshape(-1, array.shape[-1])
+		result = np.empty((flat.shape[0], channels), dtype=np.uint8)
+		for i in range(0, flat.shape[0], chunk_size):
+			result[i:i + chunk_size] = quantize(fn(flat[i:i + chunk_size].astype(np.float32) / 255))
+		return result
 	def rgb_2_cmyk(image):
-		r, g, b = image.split()
-		r_array = np.frombuffer(r.tobytes(), dtype=np.uint8) / 255
-		g_array = np.frombuffer(g.tobytes(), dtype=np.uint8) / 255
-		b_array = np.frombuffer(b.tobytes(), dtype=np.uint8) / 255
-		cmyk_array = rgb2cmyk_univ(r_array, g_array, b_array)
-		c = Image.frombuffer("L", (image.width, image.height), np.rint(cmyk_array[0].astype(np.float64) * 255).astype(np.uint8), "raw", "L", 0, 1)
-		m = Image.frombuffer("L", (image.width, image.height), np.rint(cmyk_array[1].astype(np.float64) * 255).astype(np.uint8), "raw", "L", 0, 1)
-		y = Image.frombuffer("L", (image.width, image.height), np.rint(cmyk_array[2].astype(np.float64) * 255).astype(np.uint8), "raw", "L", 0, 1)
-		k = Image.frombuffer("L", (image.width, image.height), np.rint(cmyk_array[3].astype(np.float64) * 255).astype(np.uint8), "raw", "L", 0, 1)
-		return Image.merge("CMYK", [c, m, y, k])
+		nonlocal table
+		array = np.asarray(image)
+		if lut:
+			if table is None:
+				values = np.arange(2 ** 24, dtype=np.uint32)
+				table = convert(np.stack([values >> 16, values >> 8 & 255, values & 255], axis=-1), rgb2cmyk, 4)
+			indices = array[..., 0].astype(np.uint32) << 16 | array[..., 1].astype(np.uint32) << 8 | array[..., 2]
+			cmyk = table[indices.ravel()]
+		else:
+			cmyk = convert(array, rgb2cmyk, 4)
+		return Image.frombuffer("CMYK", image.size, cmyk, "raw", "CMYK", 0, 1)
 	def cmyk_2_rgb(image):
-		c, m, y, k = image.split()
-		c_array = np.frombuffer(c.tobytes(), dtype=np.uint8) / 255
-		m_array = np.frombuffer(m.tobytes(), dtype=np.uint8) / 255
-		y_array = np.frombuffer(y.tobytes(), dtype=np.uint8) / 255
-		k_array = np.frombuffer(k.tobytes(), dtype=np.uint8) / 255
-		rgb_array = cmyk2rgb_univ(c_array, m_array, y_array, k_array)
-		r = Image.frombuffer("L", (image.width, image.height), np.rint(rgb_array[0].astype(np.float64) * 255).astype(np.uint8), "raw", "L", 0, 1)
-		g = Image.frombuffer("L", (image.width, image.height), np.rint(rgb_array[1].astype(np.float64) * 255).astype(np.uint8), "raw", "L", 0, 1)
-		b = Image.frombuffer("L", (image.width, image.height), np.rint(rgb_array[2].astype(np.float64) * 255).astype(np.uint8), "raw", "L", 0, 1)
-		return Image.merge("RGB", [r, g, b])
+		rgb = convert(np.asarray(image), cmyk2rgb, 3)
+		return Image.frombuffer("RGB", image.size, rgb, "raw", "RGB", 0, 1)
 	return rgb_2_cmyk, cmyk_2_rgb
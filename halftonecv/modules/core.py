@@ -1,10 +1,28 @@
+import hashlib
+import threading
 import numpy as np
-from sys import float_info
-from functools import cache, lru_cache
+from collections import OrderedDict
+from functools import cache
+from contextlib import contextmanager
+from contextvars import ContextVar
 from math import floor, ceil, sqrt, sin, cos, acos, pi
 from PIL import Image, ImageFilter, ImageOps
 from PIL.Image import Resampling
 from cairo import ImageSurface, Context, Antialias, Filter, Operator, Format
+from .parallel import map_channels
+from .raster import make_dot_renderer, render_dots, screen_dots
+from . import stats
+from .utils import cachefile, savecache
+
+# 品質ごとの半径の表の大きさ、Cairo のアンチエイリアス、NumPy のスタンプの中心のサブピクセル位置の量子化数
+qualities = {
+	"draft": (2 ** 8, Antialias.FAST, 1),
+	"normal": (2 ** 16, Antialias.GRAY, 4),
+	"best": (2 ** 16, Antialias.BEST, 8),
+}
+
+# 網点を描画するエンジン（screen は網点のセルごとの閾値の表と比べて塗る）
+engines = ["cairo", "numpy", "screen"]
 
 # ドット半径から着色部分の占有率を返す関数を返す
 def make_occupancy(pitch):
@@ -20,48 +38,61 @@ def make_occupancy(pitch):
 			return 1.0
 	return occupancy
 
-# 二分法による求根アルゴリズム
-def bisection(f, x1, x2, eps=float_info.epsilon):
-	while True:
-		x = (x1 + x2) / 2
-		if abs(x1 - x2) <= eps + eps * abs(x):
-			return x
-		y = f(x)
-		if f(x1) * y > 0:
-			x1 = x
-		else:
-			x2 = x
-
-# 着色部分の占有率からドット半径への変換テーブルをつくる
-def radius_table(pitch, depth):
-	color = 0
-	occupancy = 0.0
-	while occupancy <= pi / 4:
-		yield pitch * sqrt(occupancy / pi)
-		color += 1
-		occupancy = color / (depth - 1)
-	r = pitch / 2
-	rmax = sqrt(2) / 2 * pitch
-	while color < depth - 1:
-		f = make_occupancy(pitch)
-		y = lambda x: f(x) - occupancy
-		r = bisection(y, r, rmax)
-		yield r
-		color += 1
-		occupancy = color / (depth - 1)
-	yield rmax
+# ピッチを 1 としたドット半径の配列から着色部分の占有率の配列を返す
+def normalized_occupancy(radius):
+	r = np.clip(radius, 0.5, sqrt(2) / 2)
+	theta = np.arccos(1 / (2 * r))
+	overlap = r ** 2 * (pi - 4 * theta) + 2 * r * np.sin(theta)
+	return np.where(radius < 0.5, pi * np.maximum(radius, 0.0) ** 2, np.where(radius < sqrt(2) / 2, overlap, 1.0))
+
+# ピッチを 1 とした着色部分の占有率からドット半径への変換テーブルをつくる
+def normalized_radius_table(depth, iterations=64):
+	occupancy = np.arange(depth) / (depth - 1)
+	table = np.sqrt(occupancy / pi)
+	# ドットが隣と重なる範囲は二分法で一括して解く
+	overlap = occupancy > pi / 4
+	target = occupancy[overlap]
+	lower = np.full(len(target), 0.5)
+	upper = np.full(len(target), sqrt(2) / 2)
+	for _ in range(iterations):
+		middle = (lower + upper) / 2
+		below = normalized_occupancy(middle) < target
+		lower = np.where(below, middle, lower)
+		upper = np.where(below, upper, middle)
+	table[overlap] = (lower + upper) / 2
+	table[-1] = sqrt(2) / 2
+	return table
+
+# ピッチを 1 とした変換テーブルをキャッシュディレクトリがあればそこから読み込んで返す
+@cache
+def load_radius_table(depth):
+	path = cachefile(f"radius-{depth}.npy")
+	if path is not None:
+		try:
+			table = np.load(path)
+			if table.shape == (depth,):
+				return table
+		except (OSError, ValueError):
+			pass
+	table = normalized_radius_table(depth)
+	if path is not None:
+		savecache(path, lambda fp: np.save(fp, table))
+	return table
 
 # 着色部分の占有率からドット半径を返す関数を返す
 @cache
 def make_radius(pitch, depth):
-	table = list(radius_table(pitch, depth))
+	table = pitch * load_radius_table(depth)
 	def radius(occupancy):
+		# 配列はまとめて変換する
+		if np.ndim(occupancy) > 0:
+			return table[np.clip(occupancy, 0, depth - 1)]
 		if occupancy < 0:
 			return 0.0
 		elif occupancy >= depth:
 			return sqrt(2) / 2 * pitch
 		else:
-			return table[occupancy]
+			return float(table[occupancy])
 	return radius
 
 # ピクセル空間から網点空間への変換と逆変換をする関数を返す
@@ -81,191 +112,697 @@ def make_transforms(pitch, angle, origin=(0.0, 0.0)):
 		return x, y
 	return transform, inverse_transform
 
-# 画像端で座標を折り返す関数
-def reflect(x, k):
-	if x < 0:
-		return reflect(-x, k)
-	elif x <= k:
-		return x
-	elif x <= 2 * k:
-		return 2 * k - x
-	else:
-		return reflect(x % (2 * k), k)
-
-# 画像端で座標を折り返して画素値を取得する関数
-def getpixel(image, x, y):
-	i = reflect(x, image.width)
-	j = reflect(y, image.height)
-	return image.getpixel((floor(min(max(i, 0), image.width - 1)), floor(min(max(j, 0), image.height - 1))))
-
-# 最近傍リサンプリング
-def resample_nearest(image, x, y):
-	return image.getpixel((floor(min(max(x, 0), image.width - 1)), floor(min(max(y, 0), image.height - 1)))) / 255
+# 画像端で整数座標の配列を折り返す関数
+def reflect_indices(i, k):
+	a = np.abs(i)
+	a = np.where(a > 2 * k, a % (2 * k), a)
+	a = np.where(a > k, 2 * k - a, a)
+	return np.clip(a, 0, k - 1)
 
 # 線形窓関数
 def linear(x):
-	if -1 < x < 1:
-		return 1.0 - abs(x)
-	else:
-		return 0.0
-
-# 線形リサンプリング関数
-def resample_bilinear(image, x, y):
-	i = np.arange(-1, 1) + round(x)
-	j = np.arange(-1, 1) + round(y)
-	a = i - x + 0.5
-	b = j - y + 0.5
-	w = np.array([[linear(t) * linear(s) for t in a] for s in b])
-	p = np.array([[getpixel(image, t, s) for t in i] for s in j])
-	return float(np.clip(np.sum(w * p) / 255, 0.0, 1.0))
+	d = np.abs(x)
+	return np.where(d < 1, 1.0 - d, 0.0)
 
 # Lanczos 窓関数
-@lru_cache(10000 ** 2)
 def lanczos(x, n):
-	return float(np.sinc(x) * np.sinc(x / n)) if abs(x) < n else 0.0
-
-# Lanczos リサンプリング関数を返す
-def make_lanczos_resampler(n=2):
-	def resample_lanczos(image, x, y):
-		i = np.arange(-n, n) + round(x)
-		j = np.arange(-n, n) + round(y)
-		a = i - x + 0.5
-		b = j - y + 0.5
-		w_tmp = np.array([[lanczos(t, n) * lanczos(s, n) for t in a] for s in b])
-		w = w_tmp / w_tmp.sum()
-		p = np.array([[getpixel(image, t, s) for t in i] for s in j])
-		return float(np.clip(np.sum(w * p) / 255, 0.0, 1.0))
-	return resample_lanczos
+	return np.where(np.abs(x) < n, np.sinc(x) * np.sinc(x / n), 0.0)
 
 # Spline36 窓関数
-@lru_cache(10000 ** 2)
 def spline36(x):
-	d = abs(x)
-	if d <= 1.0:
-		return (((247.0 * d - 453.0) * d - 3.0) * d + 209.0) / 209.0
-	if d <= 2.0:
-		return (((-114.0 * d + 612.0) * d - 1038.0) * d + 540.0) / 209.0
-	if d <= 3.0:
-		return (((19.0 * d - 159.0) * d + 434.0) * d - 384.0) / 209.0
+	d = np.abs(x)
+	return np.select([d <= 1.0, d <= 2.0, d <= 3.0], [
+		(((247.0 * d - 453.0) * d - 3.0) * d + 209.0) / 209.0,
+		(((-114.0 * d + 612.0) * d - 1038.0) * d + 540.0) / 209.0,
+		(((19.0 * d - 159.0) * d + 434.0) * d - 384.0) / 209.0,
+	], 0.0)
+
+# 画像端で折り返した余白付きの配列を返す
+def pad_reflect(array, margin):
+	height, width = array.shape
+	j = reflect_indices(np.arange(-margin, height + margin), height)
+	i = reflect_indices(np.arange(-margin, width + margin), width)
+	return array[j[:, np.newaxis], i[np.newaxis, :]]
+
+# 複数の設定で同じ画像を網点化する間だけ共有するぼかした画像と余白付きの配列（共有しないときは None）
+shared = ContextVar("shared", default=None)
+
+# 中間結果を共有するコンテキスト
+@contextmanager
+def sharing():
+	token = shared.set({})
+	try:
+		yield
+	finally:
+		shared.reset(token)
+
+# 配列の内容を識別するキーを返す
+def fingerprint(array):
+	return array.shape, hashlib.blake2b(np.ascontiguousarray(array), digest_size=16).digest()
+
+# 画像端で折り返した余白付きの配列を返す（共有中は最も広い余白の配列を切り出して使い回す）
+def padded_array(array, margin):
+	table = shared.get()
+	if table is None:
+		return pad_reflect(array, margin)
+	key = "pad", fingerprint(array)
+	entry = table.get(key)
+	if entry is None or entry[0] < margin:
+		entry = table[key] = margin, pad_reflect(array, margin)
+	d = entry[0] - margin
+	padded = entry[1]
+	return padded[d:padded.shape[0] - d, d:padded.shape[1] - d]
+
+# ぼかしの分散（ピクセル単位）を返す
+def blur_variance(blur_name, blur_radius):
+	if blur_name == "gaussian":
+		return blur_radius ** 2
+	elif blur_name == "box":
+		return blur_radius * (blur_radius + 1) / 3
 	else:
-		return 0.0
-
-# Spline36 リサンプリング関数を返す
-def resample_spline36(image, x, y):
-	i = np.arange(-3, 3) + round(x)
-	j = np.arange(-3, 3) + round(y)
-	a = i - x + 0.5
-	b = j - y + 0.5
-	w = np.array([[spline36(t) * spline36(s) for t in a] for s in b])
-	p = np.array([[getpixel(image, t, s) for t in i] for s in j])
-	return float(np.clip(np.sum(w * p) / 255, 0.0, 1.0))
+		raise ValueError()
 
-# シングルバンドの画像から網点の位置と階調のイテレータを返す
-def halftone_dots(image, pitch, angle, blur, resampler="lanczos2", progress_callback=None):
-	center = image.width / 2, image.height / 2
-	transform, inverse_transform = make_transforms(pitch, angle, center)
-	xy_bounds = [(-pitch, -pitch), (image.width + pitch, -pitch), (image.width + pitch, image.height + pitch), (-pitch, image.height + pitch)]
-	uv_bounds = [transform(*p) for p in xy_bounds]
-	lower_u = min([u for u, v in uv_bounds])
-	upper_u = max([u for u, v in uv_bounds])
-	lower_v = min([v for u, v in uv_bounds])
-	upper_v = max([v for u, v in uv_bounds])
-	boundary = lambda u, v: lower_u <= u <= upper_u and lower_v <= v <= upper_v
-	if blur is not None:
-		blur_name, blur_radius = blur
-		if blur_radius is None:
-			blur_radius = pitch / 2
+# 1/factor に縮小した画像を同じ広がりにぼかす半径を返す（縮小の平均化による分散を差し引く）
+def reduced_blur_radius(blur_name, blur_radius, factor):
+	variance = max(0.0, blur_variance(blur_name, blur_radius) - (factor ** 2 - 1) / 12) / factor ** 2
+	if blur_name == "gaussian":
+		return sqrt(variance)
+	return (sqrt(1 + 12 * variance) - 1) / 2
+
+# ぼかした画像を返す（共有中はぼかしの種類と半径と縮小の倍率ごとに使い回す）
+# factor が 1 より大きければ平均画素法で 1/factor に縮小してから、縮小した画像で同じ広がりになるようにぼかす
+def blur_image(image, blur, pitch, factor=1):
+	blur_name, blur_radius = blur
+	if blur_radius is None:
+		blur_radius = pitch / 2
+	if blur_name not in ["gaussian", "box"]:
+		raise ValueError()
+	table = shared.get()
+	if table is not None:
+		key = "blur", fingerprint(np.asarray(image)), blur_name, blur_radius, factor
+		if key in table:
+			return table[key]
+	if factor > 1:
+		image = image.reduce(factor)
+		blur_radius = reduced_blur_radius(blur_name, blur_radius, factor)
+	if blur_radius > 0:
 		if blur_name == "gaussian":
 			image = image.filter(ImageFilter.GaussianBlur(blur_radius))
-		elif blur_name == "box":
-			image = image.filter(ImageFilter.BoxBlur(blur_radius))
 		else:
-			raise ValueError()
+			image = image.filter(ImageFilter.BoxBlur(blur_radius))
+	if table is not None:
+		table[key] = image
+	return image
+
+# 最近傍リサンプリング関数を返す
+def make_nearest_resampler():
+	def prepare(array, margin):
+		height, width = array.shape
+		def resample(xs, ys, key=None):
+			i = np.floor(np.clip(xs, 0, width - 1)).astype(np.int64)
+			j = np.floor(np.clip(ys, 0, height - 1)).astype(np.int64)
+			return array[j, i] / 255
+		return resample
+	return prepare
+
+# 分離可能な窓関数で座標の配列を一括リサンプリングする関数を返す
+# 重みはサブピクセル位相を 1/phases 画素ごとに求めたテーブルの隣り合う行を線形補間して引く
+# 窓関数を直接計算した逐次処理との階調の差は同梱の画像で 1e-7 未満（16 ビットの網点の表の 0.01 段階未満）になる
+# key を渡すと、座標だけから決まる重みと中心の画素の位置を網点の配置のキャッシュで使い回す
+def make_separable_resampler(window, n, normalize=False, phases=2 ** 12):
+	offsets = np.arange(-n, n)
+	table = window(offsets[np.newaxis, :] + np.linspace(0.0, 1.0, phases + 1)[:, np.newaxis])
+	if normalize:
+		table /= table.sum(axis=1, keepdims=True)
+	slope = np.diff(table, axis=0)
+	# 位相 t の重み
+	def lookup(t):
+		t = t * phases
+		k = np.minimum(t.astype(np.int64), phases - 1)
+		return table[k] + (t - k)[:, np.newaxis] * slope[k]
+	def weights(xs, ys):
+		x0 = np.round(xs)
+		y0 = np.round(ys)
+		return lookup(x0 - xs + 0.5), lookup(y0 - ys + 0.5), x0.astype(np.int64), y0.astype(np.int64)
+	def prepare(array, margin):
+		pad = ceil(margin) + n + 1
+		padded = padded_array(array, pad)
+		def resample(xs, ys, key=None):
+			wx, wy, x0, y0 = cached_geometry(key, lambda: weights(xs, ys))
+			i = x0[:, np.newaxis] + (offsets + pad)
+			j = y0[:, np.newaxis] + (offsets + pad)
+			p = padded[j[:, :, np.newaxis], i[:, np.newaxis, :]]
+			return np.clip(np.einsum("nj,nji,ni->n", wy, p, wx) / 255, 0.0, 1.0)
+		return resample
+	return prepare
+
+# 画素の総和の表（summed-area table）を返す（共有中は使い回す）
+# 行 j 列 i の要素は画像の上 j 行、左 i 列の画素の総和で、画素数が少なければ 32 ビットで足りる
+def summed_area_table(array):
+	table = shared.get()
+	if table is not None:
+		key = "sat", fingerprint(array)
+		if key in table:
+			return table[key]
+	height, width = array.shape
+	dtype = np.uint32 if height * width < 2 ** 32 // 255 else np.uint64
+	sat = np.zeros((height + 1, width + 1), dtype=dtype)
+	np.cumsum(np.cumsum(array, axis=0, dtype=dtype), axis=1, out=sat[1:, 1:])
+	if table is not None:
+		table[key] = sat
+	return sat
+
+# 網点の中心を中心とする網点の間隔の大きさの正方形の平均で標本化する関数を返す（margin を網点の間隔とする）
+# 正方形の積分は総和の表を双線形補間して求めるので、網点の間隔によらず網点あたり一定の計算量で済む
+# 正方形は画像に収まる部分だけを平均する
+def make_area_resampler():
+	def prepare(array, margin):
+		height, width = array.shape
+		sat = summed_area_table(array)
+		half = margin / 2
+		# 原点から (x, y) までの矩形の画素値の積分
+		def integral(x, y):
+			i = np.minimum(x.astype(np.int64), width - 1)
+			j = np.minimum(y.astype(np.int64), height - 1)
+			a = x - i
+			b = y - j
+			s00 = sat[j, i].astype(np.float64)
+			s01 = sat[j, i + 1] - s00
+			s10 = sat[j + 1, i] - s00
+			s11 = sat[j + 1, i + 1] - s00
+			return s00 + a * s01 + b * s10 + a * b * (s11 - s01 - s10)
+		def resample(xs, ys, key=None):
+			xs = np.clip(xs, 0, width)
+			ys = np.clip(ys, 0, height)
+			x0, x1 = np.maximum(xs - half, 0), np.minimum(xs + half, width)
+			y0, y1 = np.maximum(ys - half, 0), np.minimum(ys + half, height)
+			total = integral(x1, y1) - integral(x0, y1) - integral(x1, y0) + integral(x0, y0)
+			return np.clip(total / ((x1 - x0) * (y1 - y0)) / 255, 0.0, 1.0)
+		return resample
+	return prepare
+
+# 1/factor に縮小した画像から元の画像の座標で標本化する関数を返す
+def make_reduced_resampler(prepare, image, factor, margin):
+	resample = prepare(np.asarray(image), margin / factor)
+	if factor == 1:
+		return resample
+	return lambda xs, ys, key=None: resample(xs / factor, ys / factor, key)
+
+# 名前からリサンプリング関数を返す
+@cache
+def get_resampler(resampler):
 	if resampler == "nearest":
-		resample = resample_nearest
+		return make_nearest_resampler()
 	elif resampler == "linear":
-		resample = resample_bilinear
+		return make_separable_resampler(linear, 1)
 	elif resampler == "lanczos2":
-		resample = make_lanczos_resampler(n=2)
+		return make_separable_resampler(lambda x: lanczos(x, 2), 2, normalize=True)
 	elif resampler == "lanczos3":
-		resample = make_lanczos_resampler(n=3)
+		return make_separable_resampler(lambda x: lanczos(x, 3), 3, normalize=True)
 	elif resampler == "spline36":
-		resample = resample_spline36
+		return make_separable_resampler(spline36, 3)
+	elif resampler == "area":
+		return make_area_resampler()
 	else:
 		raise ValueError()
-	us = range(floor(lower_u), ceil(upper_u) + 1)
-	vs = range(floor(lower_v), ceil(upper_v) + 1)
-	count = len(us) * len(vs)
-	i = 0
-	for u in us:
-		for v in vs:
-			i += 1
-			if boundary(u, v):
-				x, y = inverse_transform(u, v)
-				if -pitch < x < image.width + pitch and -pitch < y < image.height + pitch:
-					color = resample(image, x, y)
-					if progress_callback is not None:
-						progress_callback(i / count)
-					yield x, y, color
+
+# 矩形の周囲を含めて画像を切り出した範囲を返す（縮小する場合は縮小の単位に揃える）
+def crop_box(image, window, margin, factor=1):
+	x0, y0, x1, y1 = window
+	left = max(0, floor(x0) - margin) // factor * factor
+	top = max(0, floor(y0) - margin) // factor * factor
+	right = min(image.width, ceil(x1) + margin + factor)
+	bottom = min(image.height, ceil(y1) + margin + factor)
+	return left, top, max(left + 1, right), max(top + 1, bottom)
+
+# 配列とそれを含むタプルやリストの配列を書き換えできなくし、配列の合計のバイト数を返す
+def freeze(value):
+	if isinstance(value, np.ndarray):
+		value.flags.writeable = False
+		return value.nbytes
+	if isinstance(value, (tuple, list)):
+		return sum(freeze(v) for v in value)
+	return 0
+
+# 網点の中心の座標と標本化の重みの表を、画像の大きさと網点の配置ごとに保持する LRU キャッシュ
+# 保持する配列の合計が max_memory バイトを超えると、最も長く使われていないものから捨てる（None なら無制限）
+class GeometryCache:
+	def __init__(self, max_memory=2 ** 28):
+		self.max_memory = max_memory
+		self.entries = OrderedDict()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	# キーに対応する値を返し、無ければ構築して保持する（上限より大きな値は保持しない）
+	def fetch(self, key, build):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.hits += 1
+				self.entries.move_to_end(key)
+				return entry[1]
+			self.misses += 1
+		value = build()
+		nbytes = freeze(value)
+		with self.lock:
+			if key not in self.entries and (self.max_memory is None or nbytes <= self.max_memory):
+				self.entries[key] = nbytes, value
+				self.nbytes += nbytes
+			while self.max_memory is not None and self.nbytes > self.max_memory:
+				_, (n, _) = self.entries.popitem(last=False)
+				self.nbytes -= n
+				self.evictions += 1
+		return value
+
+# 網点の配置を使い回すキャッシュ（使い回さないときは None）
+geometry = ContextVar("geometry", default=None)
+
+# 網点の配置を cache に保持して使い回すコンテキスト（cache が None なら使い回さない）
+@contextmanager
+def reusing(cache):
+	token = geometry.set(cache)
+	try:
+		yield
+	finally:
+		geometry.reset(token)
+
+# 網点の配置だけから決まる値を返す（使い回し中は key ごとに保持した値を返し、key が None なら毎回求める）
+def cached_geometry(key, build):
+	cache = geometry.get()
+	if cache is None or key is None:
+		return build()
+	return cache.fetch(key, build)
+
+# 大きさ size の画像に置く網点の中心の座標と走査の進捗をチャンクごとに返すイテレータ
+# window (x0, y0, x1, y1) を指定すると中心がその中にある網点だけを画像全体と同じ格子で返す
+# 格子の行ごとに画像（と矩形）に掛かる範囲を求めて走査するので、走査する格子点の数は返す網点の数とほぼ等しい
+# 網点は画像の上から下へ行ごとに並び、チャンクは横長の帯になる
+def lattice_chunks(size, pitch, angle, window=None, chunk_size=2 ** 16):
+	width, height = size
+	center = width / 2, height / 2
+	transform, inverse_transform = make_transforms(pitch, angle, center)
+	xy_bounds = [(-pitch, -pitch), (width + pitch, -pitch), (width + pitch, height + pitch), (-pitch, height + pitch)]
+	uv_bounds = [transform(*p) for p in xy_bounds]
+	lower_u = min([u for u, v in uv_bounds])
+	upper_u = max([u for u, v in uv_bounds])
+	lower_v = min([v for u, v in uv_bounds])
+	upper_v = max([v for u, v in uv_bounds])
+	u_range = [floor(lower_u), ceil(upper_u)]
+	v_range = [floor(lower_v), ceil(upper_v)]
+	x_range = [-pitch, width + pitch]
+	y_range = [-pitch, height + pitch]
+	if window is not None:
+		# 矩形に掛かる格子点だけを走査する
+		x0, y0, x1, y1 = window
+		uv_window = [transform(*p) for p in [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]]
+		u_range = [max(u_range[0], floor(min([u for u, v in uv_window]))), min(u_range[1], ceil(max([u for u, v in uv_window])))]
+		v_range = [max(v_range[0], floor(min([v for u, v in uv_window]))), min(v_range[1], ceil(max([v for u, v in uv_window])))]
+		x_range = [max(x_range[0], x0), min(x_range[1], x1)]
+		y_range = [max(y_range[0], y0), min(y_range[1], y1)]
+	# 格子の 2 つの軸のうち画像の縦方向に大きく進むほうを行の軸にする
+	ox, oy = inverse_transform(0.0, 0.0)
+	ux, uy = (c - o for c, o in zip(inverse_transform(1.0, 0.0), (ox, oy)))
+	vx, vy = (c - o for c, o in zip(inverse_transform(0.0, 1.0), (ox, oy)))
+	u_major = abs(uy) > abs(vy)
+	if u_major:
+		(outer_range, inner_range), (sx, sy), (tx, ty) = (u_range, v_range), (ux, uy), (vx, vy)
+	else:
+		(outer_range, inner_range), (sx, sy), (tx, ty) = (v_range, u_range), (vx, vy), (ux, uy)
+	outer = np.arange(outer_range[0], outer_range[1] + 1)
+	# 行ごとに、画像の座標が範囲に収まる列の番号の区間を求める（端の判定は後で正確に行うので 1 つずつ広げる）
+	first = np.full(len(outer), float(inner_range[0]))
+	last = np.full(len(outer), float(inner_range[1]))
+	for base, step, (lo, hi) in [(ox + sx * outer, tx, x_range), (oy + sy * outer, ty, y_range)]:
+		if abs(step) > 1e-9 * pitch:
+			t0, t1 = (lo - base) / step, (hi - base) / step
+			first = np.maximum(first, np.minimum(t0, t1) - 1)
+			last = np.minimum(last, np.maximum(t0, t1) + 1)
+		else:
+			# 列の軸に沿ってほとんど動かない向きでは、丸め誤差で動く分だけ広げて行ごとに判定する
+			slack = abs(step) * max(abs(inner_range[0]), abs(inner_range[1])) + 1e-9 * pitch
+			outside = (base < lo - slack) | (hi + slack < base)
+			first[outside], last[outside] = inner_range[1] + 1, inner_range[0] - 1
+	first = np.ceil(np.clip(first, inner_range[0] - 1, inner_range[1] + 1)).astype(np.int64)
+	last = np.floor(np.clip(last, inner_range[0] - 1, inner_range[1] + 1)).astype(np.int64)
+	counts = np.maximum(last - first + 1, 0)
+	ends = np.cumsum(counts)
+	count = max(1, int(ends[-1])) if len(ends) > 0 else 1
+	k = 0
+	while k < len(outer):
+		# 走査する格子点がおよそ chunk_size 個になるように行をまとめる
+		start = int(ends[k - 1]) if k > 0 else 0
+		stop = max(k + 1, int(np.searchsorted(ends, start + chunk_size, side="right")))
+		n = counts[k:stop]
+		s = np.repeat(outer[k:stop], n)
+		t = np.repeat(first[k:stop] - (np.cumsum(n) - n), n) + np.arange(int(ends[stop - 1]) - start)
+		u, v = (s, t) if u_major else (t, s)
+		mask = (lower_u <= u) & (u <= upper_u) & (lower_v <= v) & (v <= upper_v)
+		x, y = inverse_transform(u, v)
+		mask &= (-pitch < x) & (x < width + pitch) & (-pitch < y) & (y < height + pitch)
+		if window is not None:
+			mask &= (x0 <= x) & (x <= x1) & (y0 <= y) & (y <= y1)
+		yield x[mask], y[mask], int(ends[stop - 1]) / count
+		k = stop
+
+# 網点の中心の座標のチャンクを返す（使い回し中は画像の大きさ、ピッチ、角度、範囲ごとに保持した座標を返す）
+def lattice(size, pitch, angle, window=None, chunk_size=2 ** 16):
+	if geometry.get() is None:
+		return lattice_chunks(size, pitch, angle, window, chunk_size)
+	key = "lattice", size, pitch, angle, window, chunk_size
+	return cached_geometry(key, lambda: list(lattice_chunks(size, pitch, angle, window, chunk_size)))
+
+# シングルバンドの画像から網点の位置と階調の配列をチャンクごとに返すイテレータ
+# 下書きの品質では縮小した画像を（ぼかしも縮小した画像で近似して）最近傍で標本化する
+# window (x0, y0, x1, y1) を指定すると中心がその中にある網点だけを画像全体と同じ格子で返し、ぼかしと標本化もその周囲だけで行う
+def halftone_dot_chunks(image, pitch, angle, blur, resampler="lanczos2", progress_callback=None, chunk_size=2 ** 16, quality="normal", window=None):
+	chunks = lattice(image.size, pitch, angle, window, chunk_size)
+	key = image.size, pitch, angle, window, chunk_size
+	factor = max(1, int(pitch // 2)) if quality == "draft" else 1
+	offset = 0, 0
+	if window is not None:
+		# ぼかしとリサンプリングの範囲が収まるように周囲を含めて切り出す
+		margin = 4
+		if blur is not None:
+			margin += ceil(4 * (pitch / 2 if blur[1] is None else blur[1]))
+		if resampler == "area":
+			margin += ceil(pitch / 2)
+		box = crop_box(image, window, margin, factor)
+		image = image.crop(box)
+		offset = box[:2]
+	if blur is not None:
+		image = blur_image(image, blur, pitch, factor)
+	elif factor > 1:
+		image = image.reduce(factor)
+	if quality == "draft":
+		resampler = "nearest"
+		resample = make_reduced_resampler(make_nearest_resampler(), image, factor, pitch)
+	else:
+		resample = make_reduced_resampler(get_resampler(resampler), image, factor, pitch)
+	for k, (x, y, p) in enumerate(chunks):
+		if progress_callback is not None:
+			progress_callback(p)
+		if len(x) > 0:
+			yield x, y, resample(x - offset[0], y - offset[1], ("weights", *key, k, resampler, factor, offset))
 	if progress_callback is not None:
 		progress_callback(1.0)
 
-# シングルバンドの画像を網点化した画像を返す
-def halftone_image(image, pitch, angle, scale, blur=None, resampler="lanczos2", keep_flag=False, progress_callback=None):
-	width = round(image.width * scale)
-	height = round(image.height * scale)
-	if keep_flag:
-		res = image.resize((width, height), Resampling.LANCZOS)
-		if progress_callback is not None:
-			progress_callback(1.0)
-		return res
-	foreground = (1.0, 1.0, 1.0, 1.0)
-	background = (0.0, 0.0, 0.0, 1.0)
-	radius = make_radius(pitch, 2 ** 16)
-	surface = ImageSurface(Format.ARGB32, width, height)
+# シングルバンドの画像から網点の位置と階調のイテレータを返す
+def halftone_dots(image, pitch, angle, blur, resampler="lanczos2", progress_callback=None, quality="normal"):
+	for xs, ys, colors in halftone_dot_chunks(image, pitch, angle, blur, resampler, progress_callback, quality=quality):
+		yield from zip(xs.tolist(), ys.tolist(), colors.tolist())
+
+# 網点を描画するための背景を塗りつぶした 8 ビットのアルファのみの面を返す
+def make_surface(width, height, antialias=Antialias.GRAY):
+	foreground = (0.0, 0.0, 0.0, 1.0)
+	background = (0.0, 0.0, 0.0, 0.0)
+	surface = ImageSurface(Format.A8, width, height)
 	context = Context(surface)
 	pattern = context.get_source()
 	pattern.set_filter(Filter.BEST)
-	context.set_antialias(Antialias.GRAY)
+	context.set_antialias(antialias)
 	context.set_operator(Operator.SOURCE)
 	context.set_source_rgba(*background)
 	context.rectangle(0, 0, width, height)
 	context.fill()
 	context.set_source_rgba(*foreground)
-	for x, y, color in halftone_dots(image, pitch, angle, blur, resampler, progress_callback=progress_callback):
-		r = radius(round(color * (2 ** 16 - 1))) * scale
+	return surface, context
+
+# 描画した面のバッファをコピーせずにシングルバンドの画像として返す
+def surface_image(surface):
+	surface.flush()
+	width, height = surface.get_width(), surface.get_height()
+	return Image.frombuffer("L", (width, height), surface.get_data(), "raw", "L", surface.get_stride(), 1)
+
+# メモリの上限から帯状に描画する行数を返す
+def band_height(width, height, max_memory=None):
+	if max_memory is None:
+		return height
+	return max(1, min(height, int(max_memory // Format.A8.stride_for_width(max(1, width)))))
+
+# ピッチを 1 とした網点のセルの位置ごとに、そこを塗る最小の階調を並べた閾値の表を返す
+# セルの中心からの距離に網点の半径が達する階調を半径の表から求めるので、一様な階調のセルを塗る割合はその占有率に等しい
+@cache
+def threshold_cell(depth, size=2 ** 9):
+	t = (np.arange(size) + 0.5) / size - 0.5
+	distance = np.sqrt(t[:, np.newaxis] ** 2 + t[np.newaxis, :] ** 2)
+	# 階調 0 の網点は描画しない
+	cell = np.maximum(np.searchsorted(load_radius_table(depth), distance, side="left"), 1).astype(np.int32)
+	cell.flags.writeable = False
+	return cell
+
+# 網点の中心と階調の配列から黒地に白の網点を描画した帯状の画像を返す（left と top は出力画像での帯の位置）
+# screen エンジンでは網点の格子 (pitch, angle, origin) を screen に渡す
+def draw_dots(xs, ys, colors, radius, scale, width, height, top=0, engine="cairo", quality="normal", left=0, screen=None):
+	depth, antialias, phases = qualities[quality]
+	if engine == "screen":
+		levels = np.rint(colors * (depth - 1)).astype(np.int64)
+		return screen_dots(xs, ys, levels, threshold_cell(depth), *screen, scale, width, height, top, left)
+	if engine == "numpy":
+		radii = radius(np.rint(colors * (depth - 1)).astype(np.int64)) * scale
+		return render_dots(xs * scale, ys * scale, radii, width, height, top, phases, left)
+	surface, context = make_surface(width, height, antialias)
+	context.translate(-left, -top)
+	for x, y, color in zip(xs.tolist(), ys.tolist(), colors.tolist()):
+		r = radius(round(color * (depth - 1))) * scale
 		context.arc(x * scale, y * scale, r, 0, 2 * pi)
 		context.fill()
-	return Image.frombuffer("RGBA", (width, height), surface.get_data(), "raw", "RGBA", 0, 1).getchannel("G")
+	return surface_image(surface)
+
+# 網点の中心と階調の配列から、帯 (height, top) に黒地に白の網点を描画した画像を返す関数を返す（margin は帯に掛かる網点の中心の帯からの距離）
+# numpy エンジンでは網点をスタンプごとにまとめるのを一度だけ行い、他のエンジンでは帯に掛かる網点だけを元の順序で描画する
+def make_band_drawer(xs, ys, colors, radius, scale, width, margin, engine="cairo", quality="normal", left=0, screen=None):
+	if engine == "numpy":
+		depth, antialias, phases = qualities[quality]
+		render = make_dot_renderer(xs * scale, ys * scale, radius(np.rint(colors * (depth - 1)).astype(np.int64)) * scale, phases)
+		return lambda height, top: render(width, height, top, left)
+	order = np.argsort(ys, kind="stable")
+	sorted_ys = ys[order] * scale
+	def draw(height, top):
+		lo = np.searchsorted(sorted_ys, top - margin, side="left")
+		hi = np.searchsorted(sorted_ys, top + height + margin, side="right")
+		indices = np.sort(order[lo:hi])
+		return draw_dots(xs[indices], ys[indices], colors[indices], radius, scale, width, height, top, engine, quality, left, screen)
+	return draw
+
+# 出力画像の大きさと描画する矩形 (left, top, width, height) を返す
+def output_region(image, scale, region=None):
+	full_width = round(image.width * scale)
+	full_height = round(image.height * scale)
+	if region is None:
+		return full_width, full_height, (0, 0, full_width, full_height)
+	left, top, width, height = region
+	if left < 0 or top < 0 or width < 1 or height < 1 or left + width > full_width or top + height > full_height:
+		raise ValueError("region is out of the output image")
+	return full_width, full_height, (left, top, width, height)
+
+# シングルバンドの画像を網点化した画像を上から帯状に分割して返すイテレータ
+# region (left, top, width, height) を指定すると出力画像のその矩形だけを画像全体と同じ網点で描画する
+def halftone_image_bands(image, pitch, angle, scale, blur=None, resampler="lanczos2", keep_flag=False, progress_callback=None, max_memory=None, engine="cairo", quality="normal", region=None):
+	full_width, full_height, (left, offset, width, height) = output_region(image, scale, region)
+	rows = band_height(width, height, max_memory)
+	if engine not in engines or quality not in qualities:
+		raise ValueError()
+	if keep_flag:
+		box = None if region is None else (left * image.width / full_width, offset * image.height / full_height, (left + width) * image.width / full_width, (offset + height) * image.height / full_height)
+		res = image.resize((width, height), Resampling.LANCZOS, box=box)
+		if progress_callback is not None:
+			progress_callback(1.0)
+		if rows >= height:
+			yield 0, res
+			return
+		for top in range(0, height, rows):
+			yield top, res.crop((0, top, width, min(top + rows, height)))
+		return
+	depth, antialias, phases = qualities[quality]
+	radius = make_radius(pitch, depth)
+	screen = pitch, angle, (image.width / 2, image.height / 2)
+	margin = sqrt(2) / 2 * pitch * scale + 1
+	# 矩形に掛かる網点の中心の範囲（入力画像の座標）
+	window = None
+	if region is not None:
+		window = (left - margin) / scale, (offset - margin) / scale, (left + width + margin) / scale, (offset + height + margin) / scale
+	# Cairo で一度に描画できる場合はドットを求めながら描画する
+	if engine == "cairo" and rows >= height:
+		surface, context = make_surface(width, height, antialias)
+		context.translate(-left, -offset)
+		for xs, ys, colors in stats.timed("sample", halftone_dot_chunks(image, pitch, angle, blur, resampler, progress_callback=progress_callback, quality=quality, window=window)):
+			stats.count("dots", len(xs))
+			with stats.stage("render"):
+				for x, y, color in zip(xs.tolist(), ys.tolist(), colors.tolist()):
+					r = radius(round(color * (depth - 1))) * scale
+					context.arc(x * scale, y * scale, r, 0, 2 * pi)
+					context.fill()
+		yield 0, surface_image(surface)
+		return
+	# 全ドットを求めて縦方向に整列する
+	fn = None if progress_callback is None else lambda p: progress_callback(p / 2)
+	chunks = list(stats.timed("sample", halftone_dot_chunks(image, pitch, angle, blur, resampler, progress_callback=fn, quality=quality, window=window)))
+	xs = np.concatenate([np.zeros(0)] + [x for x, y, c in chunks])
+	ys = np.concatenate([np.zeros(0)] + [y for x, y, c in chunks])
+	colors = np.concatenate([np.zeros(0)] + [c for x, y, c in chunks])
+	del chunks
+	stats.count("dots", len(xs))
+	with stats.stage("render"):
+		draw = make_band_drawer(xs, ys, colors, radius, scale, width, margin, engine, quality, left, screen)
+	del xs, ys, colors
+	for top in range(0, height, rows):
+		bottom = min(top + rows, height)
+		with stats.stage("render"):
+			band = draw(bottom - top, offset + top)
+		if progress_callback is not None:
+			progress_callback(0.5 + bottom / height / 2)
+		yield top, band
+
+# シングルバンドの画像を網点化した画像を返す
+def halftone_image(image, pitch, angle, scale, blur=None, resampler="lanczos2", keep_flag=False, progress_callback=None, max_memory=None, engine="cairo", quality="normal", region=None):
+	width, height = output_region(image, scale, region)[2][2:]
+	bands = halftone_image_bands(image, pitch, angle, scale, blur, resampler, keep_flag, progress_callback, max_memory, engine, quality, region)
+	if band_height(width, height, max_memory) >= height:
+		for top, band in bands:
+			return band
+	result = Image.new("L", (width, height))
+	for top, band in bands:
+		result.paste(band, (0, top))
+	return result
 
 # グレースケールの画像を網点化した画像を返す
-def halftone_grayscale_image(image, pitch, angle=45, scale=1.0, blur=None, resampler="lanczos2", keep_flag=False, preserve_profile=True, progress_callback=None):
+def halftone_grayscale_image(image, pitch, angle=45, scale=1.0, blur=None, resampler="lanczos2", keep_flag=False, preserve_profile=True, progress_callback=None, max_memory=None, engine="cairo", quality="normal", region=None):
 	inverted = ImageOps.invert(image)
-	halftone = halftone_image(inverted, pitch, angle, scale, blur, resampler, keep_flag, progress_callback=progress_callback)
+	halftone = halftone_image(inverted, pitch, angle, scale, blur, resampler, keep_flag, progress_callback=progress_callback, max_memory=max_memory, engine=engine, quality=quality, region=region)
 	result = ImageOps.invert(halftone)
 	if preserve_profile and image.info.get("icc_profile") is not None:
 		result.info.update(icc_profile=image.info.get("icc_profile"))
 	return result
 
 # RGB の画像を網点化した画像を返す
-def halftone_rgb_image(image, pitch, angles=(15, 75, 30), scale=1.0, blur=None, resampler="lanczos2", keep_flags=(False, False, False), preserve_profile=True, progress_callbacks=(None, None, None)):
+def halftone_rgb_image(image, pitch, angles=(15, 75, 30), scale=1.0, blur=None, resampler="lanczos2", keep_flags=(False, False, False), preserve_profile=True, progress_callbacks=(None, None, None), workers=None, max_memory=None, engine="cairo", quality="normal", region=None):
 	r, g, b = image.split()
-	red = halftone_grayscale_image(r, pitch, angles[0], scale, blur, resampler, keep_flags[0], False, progress_callback=progress_callbacks[0])
-	green = halftone_grayscale_image(g, pitch, angles[1], scale, blur, resampler, keep_flags[1], False, progress_callback=progress_callbacks[1])
-	blue = halftone_grayscale_image(b, pitch, angles[2], scale, blur, resampler, keep_flags[2], False, progress_callback=progress_callbacks[2])
+	if workers is not None and workers > 1:
+		args_list = [(pitch, angle, scale, blur, resampler, keep_flag, False) for angle, keep_flag in zip(angles, keep_flags)]
+		red, green, blue = map_channels(halftone_grayscale_image, [r, g, b], args_list, dict(max_memory=max_memory, engine=engine, quality=quality, region=region), scale, progress_callbacks, workers)
+	else:
+		with stats.scope("R"):
+			red = halftone_grayscale_image(r, pitch, angles[0], scale, blur, resampler, keep_flags[0], False, progress_callback=progress_callbacks[0], max_memory=max_memory, engine=engine, quality=quality, region=region)
+		with stats.scope("G"):
+			green = halftone_grayscale_image(g, pitch, angles[1], scale, blur, resampler, keep_flags[1], False, progress_callback=progress_callbacks[1], max_memory=max_memory, engine=engine, quality=quality, region=region)
+		with stats.scope("B"):
+			blue = halftone_grayscale_image(b, pitch, angles[2], scale, blur, resampler, keep_flags[2], False, progress_callback=progress_callbacks[2], max_memory=max_memory, engine=engine, quality=quality, region=region)
 	halftone = Image.merge("RGB", [red, green, blue])
 	if preserve_profile and image.info.get("icc_profile") is not None:
 		halftone.info.update(icc_profile=image.info.get("icc_profile"))
 	return halftone
 
 # CMYK の画像を網点化した画像を返す
-def halftone_cmyk_image(image, pitch, angles=(15, 75, 30, 45), scale=1.0, blur=None, resampler="lanczos2", keep_flags=(False, False, False, False), preserve_profile=True, progress_callbacks=(None, None, None, None)):
+def halftone_cmyk_image(image, pitch, angles=(15, 75, 30, 45), scale=1.0, blur=None, resampler="lanczos2", keep_flags=(False, False, False, False), preserve_profile=True, progress_callbacks=(None, None, None, None), workers=None, max_memory=None, engine="cairo", quality="normal", region=None):
 	c, m, y, k = image.split()
-	cyan = halftone_image(c, pitch, angles[0], scale, blur, resampler, keep_flags[0], progress_callback=progress_callbacks[0])
-	magenta = halftone_image(m, pitch, angles[1], scale, blur, resampler, keep_flags[1], progress_callback=progress_callbacks[1])
-	yellow = halftone_image(y, pitch, angles[2], scale, blur, resampler, keep_flags[2], progress_callback=progress_callbacks[2])
-	key = halftone_image(k, pitch, angles[3], scale, blur, resampler, keep_flags[3], progress_callback=progress_callbacks[3])
+	if workers is not None and workers > 1:
+		args_list = [(pitch, angle, scale, blur, resampler, keep_flag) for angle, keep_flag in zip(angles, keep_flags)]
+		cyan, magenta, yellow, key = map_channels(halftone_image, [c, m, y, k], args_list, dict(max_memory=max_memory, engine=engine, quality=quality, region=region), scale, progress_callbacks, workers)
+	else:
+		with stats.scope("C"):
+			cyan = halftone_image(c, pitch, angles[0], scale, blur, resampler, keep_flags[0], progress_callback=progress_callbacks[0], max_memory=max_memory, engine=engine, quality=quality, region=region)
+		with stats.scope("M"):
+			magenta = halftone_image(m, pitch, angles[1], scale, blur, resampler, keep_flags[1], progress_callback=progress_callbacks[1], max_memory=max_memory, engine=engine, quality=quality, region=region)
+		with stats.scope("Y"):
+			yellow = halftone_image(y, pitch, angles[2], scale, blur, resampler, keep_flags[2], progress_callback=progress_callbacks[2], max_memory=max_memory, engine=engine, quality=quality, region=region)
+		with stats.scope("K"):
+			key = halftone_image(k, pitch, angles[3], scale, blur, resampler, keep_flags[3], progress_callback=progress_callbacks[3], max_memory=max_memory, engine=engine, quality=quality, region=region)
 	halftone = Image.merge("CMYK", [cyan, magenta, yellow, key])
 	if preserve_profile and image.info.get("icc_profile") is not None:
 		halftone.info.update(icc_profile=image.info.get("icc_profile"))
 	return halftone
+
+# Gray, RGB, CMYK の画像を網点化した画像を上から帯状に分割して返すイテレータ
+def halftone_image_mode_bands(image, pitch, angles, scale=1.0, blur=None, resampler="lanczos2", keep_flags=None, preserve_profile=True, progress_callbacks=None, max_memory=None, engine="cairo", quality="normal", region=None):
+	channels = image.split()
+	if keep_flags is None:
+		keep_flags = [False] * len(channels)
+	if progress_callbacks is None:
+		progress_callbacks = [None] * len(channels)
+	# Gray と RGB は反転して黒地に白の網点として描画する
+	invert = image.mode in ["L", "RGB"]
+	if invert:
+		channels = [ImageOps.invert(c) for c in channels]
+	generators = [stats.scoped(name, halftone_image_bands(c, pitch, angle, scale, blur, resampler, keep_flag, progress_callback=fn, max_memory=max_memory, engine=engine, quality=quality, region=region)) for name, c, angle, keep_flag, fn in zip(image.getbands(), channels, angles, keep_flags, progress_callbacks)]
+	for parts in zip(*generators):
+		top = parts[0][0]
+		bands = [ImageOps.invert(band) if invert else band for t, band in parts]
+		halftone = Image.merge(image.mode, bands)
+		if preserve_profile and image.info.get("icc_profile") is not None:
+			halftone.info.update(icc_profile=image.info.get("icc_profile"))
+		yield top, halftone
+
+# 連続するフレームの 1 チャンネルを網点化した画像と、次のフレームへ引き継ぐ状態を返す
+# 前のフレームの状態 previous を渡すと、標本値の変化が threshold 以下の網点は前のフレームの階調のまま残し、階調の変わった網点の掛かる矩形だけを描き直す
+def halftone_frame(image, pitch, angle, scale, blur=None, resampler="lanczos2", keep_flag=False, progress_callback=None, engine="cairo", quality="normal", region=None, previous=None, threshold=0.0):
+	if keep_flag:
+		return halftone_image(image, pitch, angle, scale, blur, resampler, True, progress_callback, region=region), None
+	full_width, full_height, (left, top, width, height) = output_region(image, scale, region)
+	if engine not in engines or quality not in qualities:
+		raise ValueError()
+	depth, antialias, phases = qualities[quality]
+	radius = make_radius(pitch, depth)
+	screen = pitch, angle, (image.width / 2, image.height / 2)
+	margin = sqrt(2) / 2 * pitch * scale + 1
+	window = None
+	if region is not None:
+		window = (left - margin) / scale, (top - margin) / scale, (left + width + margin) / scale, (top + height + margin) / scale
+	chunks = list(stats.timed("sample", halftone_dot_chunks(image, pitch, angle, blur, resampler, progress_callback=progress_callback, quality=quality, window=window)))
+	xs = np.concatenate([np.zeros(0)] + [x for x, y, c in chunks])
+	ys = np.concatenate([np.zeros(0)] + [y for x, y, c in chunks])
+	colors = np.concatenate([np.zeros(0)] + [c for x, y, c in chunks])
+	del chunks
+	stats.count("dots", len(xs))
+	levels = np.rint(colors * (depth - 1)).astype(np.int64)
+	key = image.size, region, len(xs)
+	# 前のフレームと網点の配置が異なれば全体を描画する
+	if previous is None or previous[0] != key:
+		with stats.stage("render"):
+			band = draw_dots(xs, ys, colors, radius, scale, width, height, top, engine, quality, left, screen)
+		return band, (key, colors, levels, band)
+	_, held_colors, held_levels, band = previous
+	changed = (levels != held_levels) & (np.abs(colors - held_colors) > threshold)
+	colors = np.where(changed, colors, held_colors)
+	levels = np.where(changed, levels, held_levels)
+	stats.count("redrawn_dots", int(np.count_nonzero(changed)))
+	# 階調の変わった網点が掛かる矩形（出力画像の座標）に掛かる網点を描き直す
+	if changed.any():
+		x0 = max(left, floor(xs[changed].min() * scale - margin))
+		y0 = max(top, floor(ys[changed].min() * scale - margin))
+		x1 = min(left + width, ceil(xs[changed].max() * scale + margin))
+		y1 = min(top + height, ceil(ys[changed].max() * scale + margin))
+		if x0 < x1 and y0 < y1:
+			near = (x0 - margin <= xs * scale) & (xs * scale <= x1 + margin) & (y0 - margin <= ys * scale) & (ys * scale <= y1 + margin)
+			with stats.stage("render"):
+				patch = draw_dots(xs[near], ys[near], colors[near], radius, scale, x1 - x0, y1 - y0, y0, engine, quality, x0, screen)
+			band = band.copy()
+			band.paste(patch, (x0 - left, y0 - top))
+	return band, (key, colors, levels, band)
+
+# Gray, RGB, CMYK の画像を連続するフレームとして網点化した画像と、次のフレームへ引き継ぐチャンネルごとの状態のリストを返す
+def halftone_frame_mode(image, pitch, angles, scale=1.0, blur=None, resampler="lanczos2", keep_flags=None, preserve_profile=True, progress_callbacks=None, engine="cairo", quality="normal", region=None, previous=None, threshold=0.0):
+	channels = image.split()
+	if keep_flags is None:
+		keep_flags = [False] * len(channels)
+	if progress_callbacks is None:
+		progress_callbacks = [None] * len(channels)
+	if previous is None or len(previous) != len(channels):
+		previous = [None] * len(channels)
+	# Gray と RGB は反転して黒地に白の網点として描画する
+	invert = image.mode in ["L", "RGB"]
+	if invert:
+		channels = [ImageOps.invert(c) for c in channels]
+	bands = []
+	states = []
+	for name, c, angle, keep_flag, fn, state in zip(image.getbands(), channels, angles, keep_flags, progress_callbacks, previous):
+		with stats.scope(name):
+			band, state = halftone_frame(c, pitch, angle, scale, blur, resampler, keep_flag, fn, engine, quality, region, state, threshold)
+		bands.append(ImageOps.invert(band) if invert else band)
+		states.append(state)
+	halftone = Image.merge(image.mode, bands)
+	if preserve_profile and image.info.get("icc_profile") is not None:
+		halftone.info.update(icc_profile=image.info.get("icc_profile"))
+	return halftone, states
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+from time import monotonic
+from .utils import writeatomic
+
+# マニフェストの形式のバージョン
+manifest_version = 1
+
+# ファイルの内容の SHA-256 を返す
+def file_digest(path, chunk_size=2 ** 20):
+	h = hashlib.sha256()
+	with open(path, "rb") as fp:
+		while chunk := fp.read(chunk_size):
+			h.update(chunk)
+	return h.hexdigest()
+
+# JSON で表せる値の SHA-256 を返す
+def value_digest(value):
+	return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+# 出力ファイルが記録した大きさと更新日時のままかどうかを返す
+def unchanged(path, size, mtime_ns):
+	try:
+		st = os.stat(path)
+	except OSError:
+		return False
+	return [st.st_size, st.st_mtime_ns] == [size, mtime_ns]
+
+# 入力ファイルの内容と出力に影響するパラメータごとに変換済みの出力ファイルを記録するマニフェスト
+class Manifest:
+	def __init__(self, path, interval=10.0):
+		self.path = path
+		self.interval = interval
+		self.entries = {}
+		self.pending = {}
+		self.hits = 0
+		self.misses = 0
+		self.dirty = False
+		self.saved = monotonic()
+		try:
+			with open(path, "rb") as fp:
+				data = json.load(fp)
+		except FileNotFoundError:
+			return
+		if isinstance(data, dict) and data.get("version") == manifest_version and isinstance(data.get("entries"), dict):
+			self.entries = data["entries"]
+
+	# 入力ファイルの出力が最新なら出力ファイルのパスを、そうでなければ None を返す
+	# 出力ファイルが記録後に変更・削除された場合も最新ではないとみなす
+	def lookup(self, source, params):
+		key = os.path.abspath(source)
+		digest = file_digest(source)
+		self.pending[key] = digest
+		entry = self.entries.get(key)
+		if entry is not None and entry.get("input") == digest and entry.get("params") == params:
+			# 出力ファイルが複数ある場合は全て変更されていないかを調べる
+			several = isinstance(entry["output"], list)
+			outputs = zip(*[entry.get(k) if several else [entry.get(k)] for k in ["output", "size", "mtime_ns"]])
+			if all(unchanged(*output) for output in outputs):
+				self.hits += 1
+				return ", ".join(entry["output"]) if several else entry["output"]
+		self.misses += 1
+		return None
+
+	# 変換した入力ファイルと出力ファイル（複数ある場合はそのリスト）を記録する（一定時間ごとにファイルへ書き出す）
+	def record(self, source, params, output):
+		key = os.path.abspath(source)
+		digest = self.pending.pop(key, None) or file_digest(source)
+		if isinstance(output, list):
+			sts = [os.stat(o) for o in output]
+			self.entries[key] = {
+				"input": digest,
+				"params": params,
+				"output": [os.path.abspath(o) for o in output],
+				"size": [st.st_size for st in sts],
+				"mtime_ns": [st.st_mtime_ns for st in sts],
+			}
+		else:
+			st = os.stat(output)
+			self.entries[key] = {
+				"input": digest,
+				"params": params,
+				"output": os.path.abspath(output),
+				"size": st.st_size,
+				"mtime_ns": st.st_mtime_ns,
+			}
+		self.dirty = True
+		if monotonic() - self.saved >= self.interval:
+			self.save()
+
+	# 変更があればマニフェストをファイルへ書き出す
+	def save(self):
+		if self.dirty:
+			data = json.dumps({"version": manifest_version, "entries": self.entries}, indent=1, sort_keys=True).encode()
+			writeatomic(self.path, lambda fp: fp.write(data))
+			self.dirty = False
+		self.saved = monotonic()
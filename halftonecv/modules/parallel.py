@@ -0,0 +1,162 @@
+import numpy as np
+from types import SimpleNamespace
+from queue import Empty
+from collections import deque
+from multiprocessing import get_context, shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+
+# ワーカープロセスから進捗を中継するキュー
+relay = None
+
+# ワーカープロセスの初期化関数
+def initialize_worker(queue):
+	global relay
+	relay = queue
+
+# 共有メモリの割り当てを解除する（例外のトレースバックがバッファを参照している場合はプロセス終了まで残す）
+def release(block):
+	try:
+		block.close()
+	except BufferError:
+		pass
+
+# 共有メモリ上のシングルバンド画像を処理して結果を共有メモリへ書き込む
+def run_channel(fn, index, source, size, target, args, kwargs):
+	src = shared_memory.SharedMemory(name=source)
+	dst = shared_memory.SharedMemory(name=target)
+	try:
+		image = Image.frombuffer("L", size, src.buf, "raw", "L", 0, 1)
+		result = fn(image, *args, progress_callback=lambda p: relay.put((index, p)), **kwargs)
+		del image
+		view = np.ndarray((result.height, result.width), dtype=np.uint8, buffer=dst.buf)
+		view[...] = np.asarray(result)
+		del view
+		return result.size
+	finally:
+		release(src)
+		release(dst)
+
+# キューに溜まった進捗をコールバックへ渡す
+def relay_progress(queue, progress_callbacks):
+	while True:
+		try:
+			index, p = queue.get_nowait()
+		except Empty:
+			return
+		if progress_callbacks[index] is not None:
+			progress_callbacks[index](p)
+
+# シングルバンド画像ごとの処理をプロセスプールへ分配して結果の画像のリストを返す
+def map_channels(fn, images, args_list, kwargs, scale, progress_callbacks, workers):
+	context = get_context()
+	queue = context.Queue()
+	blocks = []
+	try:
+		jobs = []
+		for image, args in zip(images, args_list):
+			src = shared_memory.SharedMemory(create=True, size=max(1, image.width * image.height))
+			blocks.append(src)
+			np.ndarray((image.height, image.width), dtype=np.uint8, buffer=src.buf)[...] = np.asarray(image)
+			if kwargs.get("region") is None:
+				width, height = round(image.width * scale), round(image.height * scale)
+			else:
+				width, height = kwargs["region"][2:]
+			dst = shared_memory.SharedMemory(create=True, size=max(1, width * height))
+			blocks.append(dst)
+			jobs.append((src.name, image.size, dst.name, args, kwargs))
+		with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context, initializer=initialize_worker, initargs=(queue,)) as executor:
+			futures = [executor.submit(run_channel, fn, i, *job) for i, job in enumerate(jobs)]
+			pending = set(futures)
+			while pending:
+				done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+				relay_progress(queue, progress_callbacks)
+			sizes = [future.result() for future in futures]
+		for callback in progress_callbacks:
+			if callback is not None:
+				callback(1.0)
+		return [Image.frombuffer("L", size, dst.buf, "raw", "L", 0, 1).copy() for size, dst in zip(sizes, blocks[1::2])]
+	finally:
+		for block in blocks:
+			block.close()
+			block.unlink()
+
+# ワーカープロセスの初期化関数（呼び出し側の初期化関数も続けて実行する）
+def initialize_pool_worker(queue, initializer, initargs):
+	initialize_worker(queue)
+	if initializer is not None:
+		initializer(*initargs)
+
+# ワーカープロセスから親プロセスへ進捗を送る
+def report_progress(index, value):
+	relay.put((index, value))
+
+# キューに溜まった進捗を処理の番号とともにコールバックへ渡す
+def relay_events(queue, callback):
+	while True:
+		try:
+			index, value = queue.get_nowait()
+		except Empty:
+			return
+		if callback is not None:
+			callback(index, value)
+
+# 関数をプロセスプールで並列に適用して完了した Future を引数の順に返すジェネレータ
+# 先行して投入する処理を workers * backlog 件までに抑えて、処理中や報告待ちの結果が溜まりすぎないようにする
+# 途中で閉じられたら未着手の処理を取り消し、返さなかった結果は discard へ渡す
+def imap_ordered(fn, args_list, workers, progress_callback=None, initializer=None, initargs=(), backlog=2, discard=None):
+	args_list = list(args_list)
+	context = get_context()
+	queue = context.Queue()
+	futures = []
+	consumed = 0
+	executor = ProcessPoolExecutor(max_workers=max(1, min(workers, len(args_list))), mp_context=context, initializer=initialize_pool_worker, initargs=(queue, initializer, initargs))
+	try:
+		for i in range(len(args_list)):
+			while len(futures) < min(len(args_list), i + workers * backlog):
+				futures.append(executor.submit(fn, *args_list[len(futures)]))
+			future = futures[i]
+			while not future.done():
+				wait([future], timeout=0.05)
+				relay_events(queue, progress_callback)
+			relay_events(queue, progress_callback)
+			consumed = i + 1
+			yield future
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
+		for future in futures[consumed:]:
+			if discard is not None and not future.cancelled() and future.exception() is None:
+				discard(future.result())
+
+# イテラブルの要素を別のスレッドで depth 件まで先に取り出しながら順に返すジェネレータ
+def prefetch(iterable, depth=2):
+	iterator = iter(iterable)
+	end = object()
+	executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="halftonecv-prefetch")
+	try:
+		pending = deque(executor.submit(next, iterator, end) for _ in range(depth))
+		while True:
+			item = pending.popleft().result()
+			if item is end:
+				return
+			pending.append(executor.submit(next, iterator, end))
+			yield item
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
+
+# 関数を別のスレッドで投入した順に実行するオブジェクトを返す（depth 件を超えて溜まったら古いものの完了を待つ）
+# join で残りの完了を待ち、実行中に送出された例外は submit か join で送出する
+def pipelined(fn, depth=2):
+	executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="halftonecv-pipeline")
+	pending = deque()
+	def submit(*args):
+		while len(pending) >= depth:
+			pending.popleft().result()
+		pending.append(executor.submit(fn, *args))
+	def join():
+		try:
+			while pending:
+				pending.popleft().result()
+		finally:
+			executor.shutdown(wait=True, cancel_futures=True)
+	return SimpleNamespace(submit=submit, join=join)
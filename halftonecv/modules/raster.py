@@ -0,0 +1,133 @@
+import numpy as np
+from math import ceil, cos, sin, pi
+from functools import lru_cache
+from PIL import Image
+
+# 半径の量子化数（1 ピクセルあたり）
+radius_steps = 16
+
+# 中心のサブピクセル位置の既定の量子化数（1 ピクセルあたり）
+phase_steps = 4
+
+# 小さな円の被覆率を求める 1 ピクセルあたりの標本数（1 辺あたり）
+samples = 16
+
+# 量子化した半径と中心のサブピクセル位置から円の被覆率のスタンプを返す
+@lru_cache(maxsize=2 ** 10)
+def coverage_stamp(radius_level, phase_x, phase_y, phases=phase_steps):
+	r = radius_level / radius_steps
+	k = ceil(r) + 1
+	cx = k + phase_x / phases
+	cy = k + phase_y / phases
+	# 小さな円は標本点で被覆率を求め、大きな円は画素中心からの距離で近似する
+	if r <= 2:
+		t = (np.arange((2 * k + 1) * samples) + 0.5) / samples
+		inside = ((t[np.newaxis, :] - cx) ** 2 + (t[:, np.newaxis] - cy) ** 2) <= r ** 2
+		coverage = inside.reshape(2 * k + 1, samples, 2 * k + 1, samples).mean(axis=(1, 3))
+	else:
+		t = np.arange(2 * k + 1) + 0.5
+		d = np.sqrt((t[np.newaxis, :] - cx) ** 2 + (t[:, np.newaxis] - cy) ** 2)
+		coverage = np.clip(r - d + 0.5, 0.0, 1.0)
+	stamp = np.rint(coverage * 255).astype(np.uint8)
+	stamp.flags.writeable = False
+	return stamp
+
+# 網点の中心と半径の配列から、描画する範囲 (width, height, top, left) に黒地に白の網点を描画した画像を返す関数を返す
+# 中心は 1/phases ピクセル単位に量子化する（描画する範囲によらず同じ位置になるように量子化してから範囲の位置を引く）
+# 量子化と同じスタンプを使う網点ごとの整列は一度だけ行い、範囲ごとにはそこに掛かる網点をスタンプごとに切り出すだけにする
+def make_dot_renderer(xs, ys, radii, phases=phase_steps):
+	levels = np.rint(radii * radius_steps).astype(np.int32)
+	reach = ceil(levels.max() / radius_steps) + 1 if len(levels) > 0 else 1
+	# 半径 0 の網点を除き、スタンプ、中心の行の順に並べる（網点の数に比例する配列は 32 ビットで持つ）
+	drawn = np.flatnonzero(levels > 0)
+	qx = np.rint(xs[drawn] * phases).astype(np.int32)
+	qy = np.rint(ys[drawn] * phases).astype(np.int32)
+	keys = (levels[drawn] * phases + qx % phases) * phases + qy % phases
+	del levels, drawn
+	order = np.lexsort((qy, keys))
+	keys = keys[order]
+	ix = qx[order] // phases
+	del qx
+	iy = qy[order] // phases
+	del qy, order
+	unique, starts = np.unique(keys, return_index=True)
+	# スタンプの番号と中心の行を 1 つの昇順の整数にまとめて、範囲に掛かる網点の位置を二分探索で求める
+	row = iy.min() if len(iy) > 0 else 0
+	span = int(iy.max() - row + 1) if len(iy) > 0 else 1
+	rank = np.repeat(np.arange(len(unique), dtype=np.int64) * span, np.diff(np.append(starts, len(keys)))) + (iy - row)
+	del keys
+	stamps = [coverage_stamp(level, *divmod(rest, phases), phases) for level, rest in (divmod(key, phases ** 2) for key in unique.tolist())]
+	# スタンプの塗る画素の位置と値
+	pixels = [(*np.nonzero(stamp), stamp[stamp > 0]) for stamp in stamps]
+	def render(width, height, top=0, left=0):
+		margin = 2 * reach + 2
+		canvas = np.zeros((height + 2 * margin, width + 2 * margin), dtype=np.uint8)
+		flat = canvas.reshape(-1)
+		stride = canvas.shape[1]
+		base = np.arange(len(unique)) * span
+		lo = np.searchsorted(rank, base + np.clip(top - reach - row, 0, span), side="left")
+		hi = np.searchsorted(rank, base + np.clip(top + height + reach - row, 0, span), side="left")
+		# スタンプごとの範囲を連結した網点の番号と、範囲に掛からない列の網点を除いたスタンプごとの境界
+		counts = hi - lo
+		group = np.repeat(np.arange(len(unique)), counts)
+		members = np.arange(counts.sum()) + np.repeat(lo - np.cumsum(counts) + counts, counts)
+		x = ix[members] - left
+		visible = (x + reach >= 0) & (x - reach < width)
+		members, group = members[visible], group[visible]
+		bounds = np.searchsorted(group, np.arange(len(unique) + 1))
+		for g in np.flatnonzero(np.diff(bounds)).tolist():
+			stamp = stamps[g]
+			size = stamp.shape[0]
+			selected = members[bounds[g]:bounds[g + 1]]
+			x0 = ix[selected] - left - size // 2 + margin
+			y0 = iy[selected] - top - size // 2 + margin
+			# 網点数がスタンプの塗る画素数より多いときはスタンプの画素ごとに全網点へ書き込む
+			b, a, values = pixels[g]
+			if len(selected) >= len(values):
+				corner = y0.astype(np.int64) * stride + x0
+				for offset, value in zip((b * stride + a).tolist(), values.tolist()):
+					index = corner + offset
+					flat[index] = np.maximum(flat[index], value)
+			else:
+				for x, y in zip(x0.tolist(), y0.tolist()):
+					region = canvas[y:y + size, x:x + size]
+					np.maximum(region, stamp, out=region)
+		return Image.fromarray(np.ascontiguousarray(canvas[margin:margin + height, margin:margin + width]))
+	return render
+
+# 網点の中心と半径の配列から黒地に白の網点を描画した画像を返す（left と top は描画する範囲の位置）
+def render_dots(xs, ys, radii, width, height, top=0, phases=phase_steps, left=0):
+	return make_dot_renderer(xs, ys, radii, phases)(width, height, top, left)
+
+# 網点の中心と階調の配列から、画素ごとにその画素を含むセルの網点の階調を閾値の表 cell と比べて塗った黒地に白の網点の画像を返す
+# 網点の格子はピッチ pitch、角度 angle、原点 origin（入力画像の座標）で、left と top は描画する範囲の位置
+# 画素あたり一定の計算量で済み、行を chunk_size 画素ずつに分けて処理する
+def screen_dots(xs, ys, levels, cell, pitch, angle, origin, scale, width, height, top=0, left=0, chunk_size=2 ** 20):
+	canvas = np.zeros((height, width), dtype=np.uint8)
+	if len(levels) == 0:
+		return Image.fromarray(canvas)
+	c, s = cos(angle / 180 * pi), sin(angle / 180 * pi)
+	# 網点の中心を格子の番号に戻し、周囲に階調 0 のセルを 1 つずつ加えて階調を格子状に並べる
+	dx, dy = xs - origin[0], ys - origin[1]
+	iu = np.rint((dx * c - dy * s) / pitch).astype(np.int64)
+	iv = np.rint((dx * s + dy * c) / pitch).astype(np.int64)
+	u0, v0 = iu.min() - 1, iv.min() - 1
+	rows_u, rows_v = iu.max() - u0 + 2, iv.max() - v0 + 2
+	grid = np.zeros(rows_u * rows_v, dtype=np.int32)
+	grid[(iu - u0) * rows_v + (iv - v0)] = levels
+	# 画素の中心の格子での座標を、セルの番号と閾値の表の位置を合わせた固定小数点数にする（size は 2 の冪）
+	size = cell.shape[0]
+	bits = size.bit_length() - 1
+	flat = cell.ravel()
+	x = (np.arange(width) + left + 0.5) / scale - origin[0]
+	xu = (x * c / pitch + 0.5 - u0) * size
+	xv = (x * s / pitch + 0.5 - v0) * size
+	rows = max(1, chunk_size // max(1, width))
+	for r in range(0, height, rows):
+		y = (np.arange(r, min(r + rows, height)) + top + 0.5) / scale - origin[1]
+		qu = np.clip(xu[np.newaxis, :] - (y * s / pitch * size)[:, np.newaxis], 0, rows_u * size - 1).astype(np.int32)
+		qv = np.clip(xv[np.newaxis, :] + (y * c / pitch * size)[:, np.newaxis], 0, rows_v * size - 1).astype(np.int32)
+		level = grid[(qu >> bits) * rows_v + (qv >> bits)]
+		threshold = flat[((qu & (size - 1)) << bits) | (qv & (size - 1))]
+		np.multiply(level >= threshold, 255, out=canvas[r:r + len(y)], casting="unsafe")
+	return Image.fromarray(canvas)
@@ -0,0 +1,158 @@
+import threading
+import tracemalloc
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+
+# 記録中の Stats（記録しないときは None）と記録するスレッド
+recorder = None
+owner = None
+
+# 処理の段階ごとの実行時間、確保したメモリの最大量、件数を記録する
+# メモリは tracemalloc で追跡できる Python と NumPy の割り当てだけを数える
+class Stats:
+	def __init__(self, memory=True, profile=None, profiler=None):
+		self.memory = memory
+		self.profile = profile
+		self.profiler = profiler
+		self.stages = {}
+		self.counts = {}
+		self.scopes = []
+		self.open = []
+		self.profiling = 0
+
+	# スコープを含めた名前を返す
+	def key(self, name):
+		return "/".join([*self.scopes, name])
+
+	# 開いている全段階のメモリの最大量を更新する
+	def observe(self):
+		if self.memory and tracemalloc.is_tracing():
+			current, peak = tracemalloc.get_traced_memory()
+			for frame in self.open:
+				frame[1] = max(frame[1], peak)
+			tracemalloc.reset_peak()
+			return current
+		return 0
+
+	# 段階の実行時間とメモリの最大量を記録するコンテキスト
+	@contextmanager
+	def stage(self, name):
+		key = self.key(name)
+		frame = [self.observe(), 0]
+		self.open.append(frame)
+		profiled = self.profiler is not None and self.profile in [name, key]
+		if profiled:
+			if self.profiling == 0:
+				self.profiler.enable()
+			self.profiling += 1
+		start = perf_counter()
+		try:
+			yield
+		finally:
+			elapsed = perf_counter() - start
+			if profiled:
+				self.profiling -= 1
+				if self.profiling == 0:
+					self.profiler.disable()
+			self.observe()
+			self.open.pop()
+			entry = self.stages.setdefault(key, {"sec": 0.0, "calls": 0, "peak_bytes": 0})
+			entry["sec"] += elapsed
+			entry["calls"] += 1
+			entry["peak_bytes"] = max(entry["peak_bytes"], frame[1] - frame[0])
+
+	# 以降の段階と件数の名前に接頭辞を付けるコンテキスト
+	@contextmanager
+	def scope(self, name):
+		self.scopes.append(name)
+		try:
+			yield
+		finally:
+			self.scopes.pop()
+
+	# 件数を加算する
+	def count(self, name, n=1):
+		key = self.key(name)
+		self.counts[key] = self.counts.get(key, 0) + n
+
+	# 辞書として返す
+	def as_dict(self):
+		return {"stages": self.stages, "counts": self.counts}
+
+# 記録する Stats を切り替えて以前のものを返す（記録は切り替えたスレッドでだけ行う）
+def activate(stats):
+	global recorder, owner
+	previous = recorder
+	recorder = stats
+	owner = threading.get_ident()
+	return previous
+
+# このスレッドで記録中の Stats を返す（記録しないときは None）
+def current():
+	return recorder if owner == threading.get_ident() else None
+
+# Stats を記録中にするコンテキスト
+@contextmanager
+def recording(stats):
+	previous = activate(stats)
+	try:
+		yield stats
+	finally:
+		activate(previous)
+
+# 記録中なら段階を記録するコンテキストを返す
+def stage(name):
+	stats = current()
+	return nullcontext() if stats is None else stats.stage(name)
+
+# 記録中ならスコープを付けるコンテキストを返す
+def scope(name):
+	stats = current()
+	return nullcontext() if stats is None else stats.scope(name)
+
+# 記録中なら件数を加算する
+def count(name, n=1):
+	stats = current()
+	if stats is not None:
+		stats.count(name, n)
+
+# イテレータから要素を取り出す時間を段階として記録するイテレータを返す
+def timed(name, iterable):
+	if current() is None:
+		return iterable
+	def generate():
+		iterator = iter(iterable)
+		while True:
+			with stage(name):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			yield item
+	return generate()
+
+# 要素を取り出す間だけスコープを付けるイテレータを返す
+def scoped(name, iterable):
+	if current() is None:
+		return iterable
+	def generate():
+		iterator = iter(iterable)
+		while True:
+			with scope(name):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			yield item
+	return generate()
+
+# 記録した統計を表の行のリストにして返す
+def format_table(data):
+	lines = []
+	width = max([len(k) for k in data["stages"]] + [5])
+	lines.append(f"  {'stage':<{width}} {'time':>10} {'peak':>10} {'calls':>6}")
+	for key, entry in data["stages"].items():
+		lines.append(f"  {key:<{width}} {entry['sec']:>8.3f} s {entry['peak_bytes'] / 2 ** 20:>6.1f} MiB {entry['calls']:>6}")
+	for key, n in data["counts"].items():
+		lines.append(f"  {key:<{width}} {n:>10}")
+	return lines
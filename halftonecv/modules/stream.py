@@ -0,0 +1,199 @@
+import zlib
+import struct
+import numpy as np
+from types import SimpleNamespace
+
+# TIFF のタグの型（SHORT, LONG, RATIONAL, UNDEFINED, LONG8）とそのバイト数
+tiff_types = {3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 7: ("B", 1), 16: ("Q", 8)}
+
+# 画像のモードから TIFF のサンプル数と色空間のタグを返す
+def tiff_mode_tags(mode):
+	if mode == "L":
+		return 1, [(262, 3, [1])]
+	elif mode == "LA":
+		return 2, [(262, 3, [1]), (338, 3, [2])]
+	elif mode == "RGB":
+		return 3, [(262, 3, [2])]
+	elif mode == "RGBA":
+		return 4, [(262, 3, [2]), (338, 3, [2])]
+	elif mode == "CMYK":
+		return 4, [(262, 3, [5]), (332, 3, [1])]
+	else:
+		raise ValueError(f"unsupported image mode for streaming TIFF output: {mode}")
+
+# 帯状の画像を受け取って非圧縮ストリップの TIFF を逐次書き込む関数を返す
+def make_tiff_writer(fp, mode, size, icc_profile=None, rows_per_strip=64, bigtiff=None):
+	width, height = size
+	samples, mode_tags = tiff_mode_tags(mode)
+	row_bytes = width * samples
+	strips = max(1, -(-height // rows_per_strip))
+	counts = [min(rows_per_strip, height - i * rows_per_strip) * row_bytes for i in range(strips)]
+	# 4 GiB を超える場合は BigTIFF にする
+	big = bigtiff if bigtiff is not None else 16 + sum(counts) + strips * 16 + (len(icc_profile) if icc_profile else 0) + 1024 >= 2 ** 32
+	offset_type = 16 if big else 4
+	entries = [
+		(256, 4, [width]),
+		(257, 4, [height]),
+		(258, 3, [8] * samples),
+		(259, 3, [1]),
+		(273, offset_type, [0] * strips),
+		(277, 3, [samples]),
+		(278, 4, [rows_per_strip]),
+		(279, offset_type, counts),
+		(282, 5, [72, 1]),
+		(283, 5, [72, 1]),
+		(284, 3, [1]),
+		(296, 3, [2]),
+		*mode_tags,
+	]
+	if icc_profile:
+		entries.append((34675, 7, list(icc_profile)))
+	entries.sort(key=lambda e: e[0])
+	# IFD とその外部の値を配置してからストリップのオフセットを決める
+	header_size, entry_size, inline_size = (16, 20, 8) if big else (8, 12, 4)
+	ifd_size = (8 if big else 2) + entry_size * len(entries) + (8 if big else 4)
+	external = header_size + ifd_size
+	layout = []
+	for tag, t, values in entries:
+		fmt, unit = tiff_types[t]
+		length = unit * (len(values) // 2 if t == 5 else len(values))
+		if length > inline_size:
+			layout.append(external)
+			external += length + length % 2
+		else:
+			layout.append(None)
+	data_start = external
+	offsets = [data_start + sum(counts[:i]) for i in range(strips)]
+	entries = [(tag, t, offsets if tag == 273 else values) for tag, t, values in entries]
+	# ヘッダと IFD を書き込む
+	if big:
+		head = b"II" + struct.pack("<HHHQ", 43, 8, 0, header_size)
+		head += struct.pack("<Q", len(entries))
+	else:
+		head = b"II" + struct.pack("<HI", 42, header_size)
+		head += struct.pack("<H", len(entries))
+	tail = b""
+	for (tag, t, values), position in zip(entries, layout):
+		fmt, unit = tiff_types[t]
+		count = len(values) // 2 if t == 5 else len(values)
+		data = struct.pack("<" + fmt[0] * len(values), *values)
+		if position is None:
+			field = data.ljust(inline_size, b"\0")
+		else:
+			field = struct.pack("<Q" if big else "<I", position)
+			tail += data + b"\0" * (len(data) % 2)
+		head += struct.pack("<HHQ" if big else "<HHI", tag, t, count) + field
+	head += struct.pack("<Q" if big else "<I", 0)
+	fp.write(head + tail)
+	written = 0
+	def write(band):
+		nonlocal written
+		if band.mode != mode or band.width != width or written + band.height > height:
+			raise ValueError("band does not fit the streaming output")
+		fp.write(band.tobytes())
+		written += band.height
+	return write
+
+# 画像のモードから PNG のカラータイプを返す
+def png_color_type(mode):
+	if mode == "L":
+		return 0
+	elif mode == "LA":
+		return 4
+	elif mode == "RGB":
+		return 2
+	elif mode == "RGBA":
+		return 6
+	else:
+		raise ValueError(f"unsupported image mode for streaming PNG output: {mode}")
+
+# PNG のチャンクを書き込む
+def write_png_chunk(fp, kind, data):
+	fp.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+# 行ごとに Paeth フィルタを適用したバイト列を返す関数を返す
+# rows_per_batch 行ずつ処理して作業用の配列を使い回すので、使うメモリは帯の高さによらない
+def make_paeth_filter(row_bytes, samples, rows_per_batch=64):
+	# 左端に samples バイトの 0 を加えた現在の行と上の行
+	current = np.zeros((rows_per_batch, samples + row_bytes), dtype=np.int16)
+	above = np.zeros_like(current)
+	p, pa, pb, pc = (np.empty((rows_per_batch, row_bytes), dtype=np.int16) for _ in range(4))
+	choose, test = (np.empty((rows_per_batch, row_bytes), dtype=bool) for _ in range(2))
+	filtered = np.empty((rows_per_batch, 1 + row_bytes), dtype=np.uint8)
+	filtered[:, 0] = 4
+	def paeth(rows, previous):
+		n = rows.shape[0]
+		x, a, b, c = current[:n, samples:], current[:n, :-samples], above[:n, samples:], above[:n, :-samples]
+		x[...] = rows
+		b[0] = previous
+		b[1:] = rows[:-1]
+		np.add(a, b, out=p[:n])
+		np.subtract(p[:n], c, out=p[:n])
+		for d, v in [(pa, a), (pb, b), (pc, c)]:
+			np.subtract(p[:n], v, out=d[:n])
+			np.abs(d[:n], out=d[:n])
+		# 予測値は a, b, c のうち p に最も近いもの（同じなら a, b, c の順）
+		np.copyto(p[:n], c)
+		np.less_equal(pb[:n], pc[:n], out=choose[:n])
+		np.copyto(p[:n], b, where=choose[:n])
+		np.less_equal(pa[:n], pb[:n], out=choose[:n])
+		np.less_equal(pa[:n], pc[:n], out=test[:n])
+		np.logical_and(choose[:n], test[:n], out=choose[:n])
+		np.copyto(p[:n], a, where=choose[:n])
+		np.subtract(x, p[:n], out=p[:n])
+		# 差を 256 で割った余りにする（下位 8 ビットを取り出す）
+		np.copyto(filtered[:n, 1:], p[:n], casting="unsafe")
+		return filtered[:n].tobytes()
+	return paeth
+
+# 帯状の画像を受け取って PNG を逐次書き込む関数を返す
+# 帯は rows_per_batch 行ずつ切り出してフィルタと圧縮を行う
+def make_png_writer(fp, mode, size, icc_profile=None, level=6, chunk_size=2 ** 20, rows_per_batch=64):
+	width, height = size
+	samples = len(mode)
+	fp.write(b"\x89PNG\r\n\x1a\n")
+	write_png_chunk(fp, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, png_color_type(mode), 0, 0, 0))
+	if icc_profile:
+		write_png_chunk(fp, b"iCCP", b"ICC Profile\0\0" + zlib.compress(icc_profile))
+	compressor = zlib.compressobj(level)
+	paeth = make_paeth_filter(width * samples, samples, rows_per_batch)
+	previous = np.zeros(width * samples, dtype=np.uint8)
+	pending = []
+	written = 0
+	def flush(data, force=False):
+		pending.append(data)
+		if force or sum(len(d) for d in pending) >= chunk_size:
+			idat = b"".join(pending)
+			pending.clear()
+			if idat:
+				write_png_chunk(fp, b"IDAT", idat)
+	def write(band):
+		nonlocal previous, written
+		if band.mode != mode or band.width != width or written + band.height > height:
+			raise ValueError("band does not fit the streaming output")
+		for top in range(0, band.height, rows_per_batch):
+			bottom = min(top + rows_per_batch, band.height)
+			rows = np.asarray(band.crop((0, top, width, bottom))).reshape(bottom - top, width * samples)
+			flush(compressor.compress(paeth(rows, previous)))
+			previous = rows[-1].copy()
+		written += band.height
+		if written == height:
+			flush(compressor.flush(), force=True)
+			write_png_chunk(fp, b"IEND", b"")
+	return write
+
+# 出力形式に応じて帯状の画像を逐次書き込む関数を返す
+def make_stream_writer(fp, fmt, mode, size, icc_profile=None):
+	if fmt == "TIFF":
+		return make_tiff_writer(fp, mode, size, icc_profile)
+	elif fmt == "PNG":
+		return make_png_writer(fp, mode, size, icc_profile)
+	else:
+		raise ValueError()
+
+# 複数の出力先へ同じバイト列を書き込むオブジェクトを返す
+def tee(*fps):
+	def write(data):
+		for fp in fps:
+			fp.write(data)
+	return SimpleNamespace(write=write)
@@ -1,5 +1,6 @@
 import os
 import os.path
+import tempfile
 
 # ディレクトリが無ければ再帰的に作成する
 def mkdirp(path):
@@ -23,3 +24,30 @@ def altfilepath(path, suffix="_"):
 		head, tail = os.path.split(root)
 		path = os.path.join(head, tail + suffix) + ext
 	return path
+
+# 環境変数で指定されたキャッシュディレクトリ内のファイルのパスを返す（未指定なら None）
+def cachefile(filename):
+	dirpath = os.environ.get("HALFTONECV_CACHE_DIR")
+	if not dirpath:
+		return None
+	return os.path.join(dirpath, filename)
+
+# ファイルを一時ファイル経由で不可分に書き込む
+def writeatomic(path, write):
+	dirpath = os.path.dirname(path)
+	mkdirp(dirpath)
+	fd, tmp = tempfile.mkstemp(dir=dirpath, suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as fp:
+			write(fp)
+		os.replace(tmp, path)
+	except BaseException:
+		os.remove(tmp)
+		raise
+
+# キャッシュファイルを一時ファイル経由で不可分に書き込む（失敗しても無視する）
+def savecache(path, write):
+	try:
+		writeatomic(path, write)
+	except OSError:
+		pass
@@ -0,0 +1,49 @@
+import itertools
+import numpy as np
+import pytest
+from PIL import Image
+from halftonecv.modules.color import make_fake_conversions, make_fake_transforms
+
+# 配列版の変換とスカラー版の変換の差の許容値（8 ビットの階調）
+# float32 と float64 の丸めの違いで四捨五入の境目の値が 1 階調ずれることがある
+tolerance = 1
+
+rgb_values = np.array(list(itertools.product(range(0, 256, 15), repeat=3)), dtype=np.uint8)
+cmyk_values = np.array(list(itertools.product(range(0, 256, 51), repeat=4)), dtype=np.uint8)
+
+# スカラー版の変換を 8 ビットの色の配列に適用する
+def scalar_convert(fn, values):
+	return np.array([[round(v * 255) for v in fn(*(c / 255 for c in color))] for color in values.tolist()], dtype=np.int64)
+
+# 8 ビットの色の配列を 1 行の画像にする
+def row_image(values, mode):
+	return Image.frombuffer(mode, (len(values), 1), np.ascontiguousarray(values), "raw", mode, 0, 1)
+
+@pytest.mark.parametrize("gamma_correction", [False, True])
+@pytest.mark.parametrize("k_threshold", [0.0, 0.3, 0.5, 0.99])
+def test_rgb_to_cmyk_matches_scalar(k_threshold, gamma_correction):
+	scalar, _ = make_fake_conversions(k_threshold, gamma_correction)
+	rgb_2_cmyk, _ = make_fake_transforms(k_threshold, gamma_correction)
+	expected = scalar_convert(scalar, rgb_values)
+	actual = np.asarray(rgb_2_cmyk(row_image(rgb_values, "RGB")), dtype=np.int64).reshape(-1, 4)
+	assert np.abs(actual - expected).max() <= tolerance
+
+@pytest.mark.parametrize("gamma_correction", [False, True])
+@pytest.mark.parametrize("k_threshold", [0.0, 0.5])
+def test_cmyk_to_rgb_matches_scalar(k_threshold, gamma_correction):
+	_, scalar = make_fake_conversions(k_threshold, gamma_correction)
+	_, cmyk_2_rgb = make_fake_transforms(k_threshold, gamma_correction)
+	expected = scalar_convert(scalar, cmyk_values)
+	actual = np.asarray(cmyk_2_rgb(row_image(cmyk_values, "CMYK")), dtype=np.int64).reshape(-1, 3)
+	assert np.abs(actual - expected).max() <= tolerance
+
+# LUT は配列版の変換で作るので、LUT を引いた結果は配列版と完全に一致する
+@pytest.mark.parametrize("k_threshold, gamma_correction", [(0.5, False), (0.3, True)])
+def test_rgb_to_cmyk_lut_matches_array(k_threshold, gamma_correction):
+	scalar, _ = make_fake_conversions(k_threshold, gamma_correction)
+	direct, _ = make_fake_transforms(k_threshold, gamma_correction)
+	lookup, _ = make_fake_transforms(k_threshold, gamma_correction, lut=True)
+	image = row_image(rgb_values, "RGB")
+	actual = np.asarray(lookup(image))
+	assert np.array_equal(actual, np.asarray(direct(image)))
+	assert np.abs(actual.astype(np.int64).reshape(-1, 4) - scalar_convert(scalar, rgb_values)).max() <= tolerance
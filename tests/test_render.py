@@ -0,0 +1,82 @@
+from os.path import dirname, join
+from math import pi
+import numpy as np
+import pytest
+from PIL import Image
+
+cairo = pytest.importorskip("cairo")
+
+from halftonecv.api import Converter
+from halftonecv.modules.core import halftone_dot_chunks, halftone_image, draw_dots, make_radius, qualities
+
+images_directory = join(dirname(dirname(__file__)), "images")
+
+# 同梱の画像の一部をシングルバンドで読み込む（幅は面の行の揃えと合わないように奇数にする）
+def load_crop(name="blue-hyacinths.png", box=(120, 80, 321, 230), band=0):
+	return Image.open(join(images_directory, name)).getchannel(band).crop(box)
+
+# 以前の描画方法（不透明な黒の ARGB32 の面に白で描画して緑のチャンネルを取り出す）
+def argb32_dots(image, pitch, angle, scale, quality):
+	depth, antialias, phases = qualities[quality]
+	radius = make_radius(pitch, depth)
+	width, height = round(image.width * scale), round(image.height * scale)
+	surface = cairo.ImageSurface(cairo.Format.ARGB32, width, height)
+	context = cairo.Context(surface)
+	context.get_source().set_filter(cairo.Filter.BEST)
+	context.set_antialias(antialias)
+	context.set_operator(cairo.Operator.SOURCE)
+	context.set_source_rgba(0.0, 0.0, 0.0, 1.0)
+	context.rectangle(0, 0, width, height)
+	context.fill()
+	context.set_source_rgba(1.0, 1.0, 1.0, 1.0)
+	for xs, ys, colors in halftone_dot_chunks(image, pitch, angle, None, quality=quality):
+		for x, y, color in zip(xs.tolist(), ys.tolist(), colors.tolist()):
+			context.arc(x * scale, y * scale, radius(round(color * (depth - 1))) * scale, 0, 2 * pi)
+			context.fill()
+	surface.flush()
+	return Image.frombuffer("RGBA", (width, height), bytes(surface.get_data()), "raw", "RGBA", surface.get_stride(), 1).getchannel("G")
+
+# A8 の面をコピーせずに包んだ画像は以前の ARGB32 の緑のチャンネルと一致する
+@pytest.mark.parametrize("quality", ["normal", "best"])
+@pytest.mark.parametrize("pitch, angle, scale", [(6, 45, 1.0), (5.5, 15, 1.5)])
+def test_a8_surface_matches_argb32(pitch, angle, scale, quality):
+	image = load_crop()
+	expected = np.asarray(argb32_dots(image, pitch, angle, scale, quality))
+	actual = np.asarray(halftone_image(image, pitch, angle, scale, quality=quality))
+	assert actual.shape == expected.shape
+	assert np.array_equal(actual, expected)
+	# 帯に分けて描画する draw_dots の経路も同じ
+	depth = qualities[quality][0]
+	xs, ys, colors = (np.concatenate([chunk[i] for chunk in halftone_dot_chunks(image, pitch, angle, None, quality=quality)]) for i in range(3))
+	band = draw_dots(xs, ys, colors, make_radius(pitch, depth), scale, expected.shape[1], expected.shape[0], quality=quality)
+	assert np.array_equal(np.asarray(band), expected)
+
+# 矩形を指定して描画した画像は全体を描画した画像の同じ矩形と一致する（画像からはみ出す部分は切り詰める）
+@pytest.mark.parametrize("options", [
+	dict(engine="numpy"),
+	dict(engine="numpy", mode="cmyk", scale=1.7, resample="lanczos3", blur="gaussian"),
+	dict(engine="numpy", quality="draft", pitch=7),
+	dict(engine="numpy", resample="area", pitch=9, max_memory=2 ** 12),
+	dict(engine="screen"),
+	dict(engine="screen", mode="cmyk", scale=1.3, max_memory=2 ** 12),
+	dict(engine="screen", quality="draft", pitch=7, blur="box"),
+])
+def test_region_matches_crop(options):
+	image = Image.open(join(images_directory, "blue-hyacinths.png")).crop((400, 200, 663, 391))
+	converter = Converter(**options)
+	full = converter.convert(image)
+	for region in [(0, 0, 50, 40), (101, 57, 91, 66), (200, 150, 500, 500), (1, 3, full.width - 2, full.height - 5)]:
+		part = converter.convert(image, region=region)
+		expected = full.crop((region[0], region[1], region[0] + part.width, region[1] + part.height))
+		assert part.size == (min(region[2], full.width - region[0]), min(region[3], full.height - region[1]))
+		assert np.array_equal(np.asarray(part), np.asarray(expected))
+
+# メモリの上限で帯に分けて描画した画像は一度に描画した画像と一致する
+@pytest.mark.parametrize("engine", ["cairo", "numpy", "screen"])
+@pytest.mark.parametrize("pitch, scale, options", [(6, 1.0, dict()), (5.5, 1.7, dict(resampler="lanczos3")), (7, 1.0, dict(quality="draft")), (6, 1.0, dict(region=(31, 17, 150, 120)))])
+def test_bands_match_full_render(engine, pitch, scale, options):
+	image = load_crop()
+	full = np.asarray(halftone_image(image, pitch, 30, scale, engine=engine, **options))
+	for max_memory in [2 ** 10, 5000, 2 ** 14]:
+		bands = np.asarray(halftone_image(image, pitch, 30, scale, engine=engine, max_memory=max_memory, **options))
+		assert np.array_equal(bands, full)
@@ -0,0 +1,122 @@
+from os.path import dirname, join
+from math import floor, ceil
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("cairo")
+
+from halftonecv.modules.core import halftone_dot_chunks, halftone_dots, make_transforms
+
+images_directory = join(dirname(dirname(__file__)), "images")
+
+# 配列版の標本化と逐次計算の階調の差の許容値（重みの表の補間の誤差、make_separable_resampler を参照）
+tolerance = 1e-7
+
+# 同梱の画像をシングルバンドで読み込む
+def load_channel(name, band=0):
+	image = Image.open(join(images_directory, name))
+	return image.getchannel(band) if image.mode != "L" else image
+
+# 網点の位置と階調の配列を返す
+def sample(image, pitch, angle, resampler, **kwargs):
+	chunks = list(halftone_dot_chunks(image, pitch, angle, None, resampler, **kwargs))
+	return tuple(np.concatenate([np.zeros(0)] + [chunk[i] for chunk in chunks]) for i in range(3))
+
+# 中心 (x, y) の網点の間隔の大きさの正方形（画像に収まる部分）の画素値の平均を画素との重なりの面積で重み付けして求める
+def cell_mean(array, x, y, pitch):
+	height, width = array.shape
+	x0, x1 = max(0.0, min(x, width) - pitch / 2), min(float(width), max(x, 0) + pitch / 2)
+	y0, y1 = max(0.0, min(y, height) - pitch / 2), min(float(height), max(y, 0) + pitch / 2)
+	i = np.arange(int(np.floor(x0)), int(np.ceil(x1)))
+	j = np.arange(int(np.floor(y0)), int(np.ceil(y1)))
+	wx = np.minimum(i + 1, x1) - np.maximum(i, x0)
+	wy = np.minimum(j + 1, y1) - np.maximum(j, y0)
+	return wy @ array[j[0]:j[-1] + 1, i[0]:i[-1] + 1] @ wx / ((x1 - x0) * (y1 - y0)) / 255
+
+# 面積平均の標本化は総和の表から求めても画素を足し合わせた平均と一致する
+@pytest.mark.parametrize("name, pitch, angle", [("blue-hyacinths.png", 8, 45), ("blue-hyacinths.png", 16, 15), ("chevrolet-opala.png", 5.5, 75)])
+def test_area_resampler_matches_cell_mean(name, pitch, angle):
+	image = load_channel(name)
+	array = np.asarray(image, dtype=np.float64)
+	xs, ys, colors = sample(image, pitch, angle, "area")
+	picks = np.random.default_rng(0).choice(len(xs), 2000, replace=False)
+	expected = np.array([cell_mean(array, xs[k], ys[k], pitch) for k in picks])
+	assert np.abs(colors[picks] - expected).max() < 1e-9
+
+# 逐次計算の参照実装（画素ごとに窓関数を計算する）
+def reflect(x, k):
+	if x < 0:
+		return reflect(-x, k)
+	elif x <= k:
+		return x
+	elif x <= 2 * k:
+		return 2 * k - x
+	else:
+		return reflect(x % (2 * k), k)
+
+def getpixel(image, x, y):
+	i = reflect(x, image.width)
+	j = reflect(y, image.height)
+	return image.getpixel((floor(min(max(i, 0), image.width - 1)), floor(min(max(j, 0), image.height - 1))))
+
+def linear(x):
+	return 1.0 - abs(x) if -1 < x < 1 else 0.0
+
+def lanczos(x, n):
+	return float(np.sinc(x) * np.sinc(x / n)) if abs(x) < n else 0.0
+
+def spline36(x):
+	d = abs(x)
+	if d <= 1.0:
+		return (((247.0 * d - 453.0) * d - 3.0) * d + 209.0) / 209.0
+	if d <= 2.0:
+		return (((-114.0 * d + 612.0) * d - 1038.0) * d + 540.0) / 209.0
+	if d <= 3.0:
+		return (((19.0 * d - 159.0) * d + 434.0) * d - 384.0) / 209.0
+	return 0.0
+
+# 窓関数と半径と正規化の有無
+windows = {
+	"linear": (linear, 1, False),
+	"lanczos2": (lambda x: lanczos(x, 2), 2, True),
+	"lanczos3": (lambda x: lanczos(x, 3), 3, True),
+	"spline36": (spline36, 3, False),
+}
+
+def scalar_resample(image, x, y, resampler):
+	if resampler == "nearest":
+		return image.getpixel((floor(min(max(x, 0), image.width - 1)), floor(min(max(y, 0), image.height - 1)))) / 255
+	window, n, normalize = windows[resampler]
+	i = np.arange(-n, n) + round(x)
+	j = np.arange(-n, n) + round(y)
+	w = np.array([[window(t - x + 0.5) * window(s - y + 0.5) for t in i] for s in j])
+	if normalize:
+		w = w / w.sum()
+	p = np.array([[getpixel(image, t, s) for t in i] for s in j])
+	return float(np.clip(np.sum(w * p) / 255, 0.0, 1.0))
+
+def scalar_dots(image, pitch, angle, resampler):
+	center = image.width / 2, image.height / 2
+	transform, inverse_transform = make_transforms(pitch, angle, center)
+	xy_bounds = [(-pitch, -pitch), (image.width + pitch, -pitch), (image.width + pitch, image.height + pitch), (-pitch, image.height + pitch)]
+	uv_bounds = [transform(*p) for p in xy_bounds]
+	lower_u = min([u for u, v in uv_bounds])
+	upper_u = max([u for u, v in uv_bounds])
+	lower_v = min([v for u, v in uv_bounds])
+	upper_v = max([v for u, v in uv_bounds])
+	for u in range(floor(lower_u), ceil(upper_u) + 1):
+		for v in range(floor(lower_v), ceil(upper_v) + 1):
+			x, y = inverse_transform(u, v)
+			if -pitch < x < image.width + pitch and -pitch < y < image.height + pitch:
+				yield x, y, scalar_resample(image, x, y, resampler)
+
+# 網点の位置と階調は逐次計算の参照実装と許容値の範囲で一致する
+@pytest.mark.parametrize("resampler", ["nearest", "linear", "lanczos2", "lanczos3", "spline36"])
+@pytest.mark.parametrize("name, pitch, angle", [("blue-hyacinths.png", 6, 45), ("chevrolet-opala.png", 5.5, 15)])
+def test_halftone_dots_match_scalar(name, pitch, angle, resampler):
+	image = load_channel(name).crop((200, 150, 296, 214))
+	expected = sorted(scalar_dots(image, pitch, angle, resampler))
+	actual = sorted(halftone_dots(image, pitch, angle, None, resampler))
+	assert len(actual) == len(expected)
+	assert np.abs(np.array(actual) - np.array(expected)).max() < tolerance
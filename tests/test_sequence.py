@@ -0,0 +1,37 @@
+from os.path import dirname, join
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("cairo")
+
+from halftonecv.api import Converter
+
+images_directory = join(dirname(dirname(__file__)), "images")
+
+# 同梱の画像の一部で、矩形が動くフレームと同じフレームの繰り返しと半透明のフレームを含む連続したフレームを作る
+def make_frames():
+	base = np.asarray(Image.open(join(images_directory, "blue-hyacinths.png")).crop((500, 300, 621, 397)))
+	frames = []
+	for t in range(4):
+		array = base.copy()
+		array[10 + 7 * t:40 + 7 * t, 30:70] = [255 - 50 * t, 30, 80]
+		frames.append(Image.fromarray(array))
+	frames.append(frames[-1].copy())
+	frames.append(frames[1].convert("RGBA"))
+	frames[-1].putalpha(180)
+	return frames
+
+# 閾値 0 のシーケンスの出力はフレームごとに変換した画像と一致する
+@pytest.mark.parametrize("engine", ["cairo", "numpy", "screen"])
+@pytest.mark.parametrize("options", [dict(), dict(mode="cmyk"), dict(quality="draft", pitch=5), dict(scale=1.5, blur="gaussian", resample="lanczos3")])
+@pytest.mark.parametrize("region", [None, (13, 7, 40, 33)])
+def test_sequence_matches_convert(engine, options, region):
+	frames = make_frames()
+	converter = Converter(engine=engine, **options)
+	actual = list(converter.sequence(iter(frames), region=region, threshold=0.0))
+	expected = [converter.convert(frame, region=region) for frame in frames]
+	assert len(actual) == len(expected)
+	for a, b in zip(actual, expected):
+		assert a.mode == b.mode
+		assert np.array_equal(np.asarray(a), np.asarray(b))